@@ -0,0 +1,112 @@
+"""
+Micro-benchmark of response encoding: the time to turn each endpoint's
+result into JSON bytes, the old way and the current way.
+
+    MOVIE_API_BACKEND=memory MOVIE_API_DATA_DIR=$(python -c "from test import corpus; print(corpus.data_dir())") python benchmarks/encode.py --runs 500
+
+"before" runs the result through jsonable_encoder and the stdlib encoder,
+as FastAPI does for a returned value. "after" hands it to
+src.encoding.dumps (orjson) as the routers now do. The database is queried
+once per endpoint, outside the timings.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import sqlalchemy  # noqa: E402
+from fastapi import Response  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+from src import database as db  # noqa: E402
+from src import encoding  # noqa: E402
+from src.api import characters, lines, movies  # noqa: E402
+
+
+def before(value):
+    return json.dumps(
+        jsonable_encoder(value),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def after(value):
+    return encoding.dumps(value)
+
+
+async def lines_page(limit):
+    "the rows of /lines/?limit=<limit>, which isn't cached and so has no raw form"
+    stmt = (
+        sqlalchemy.select(
+            db.lines.c.line_id,
+            db.characters.c.name.label("character"),
+            db.movies.c.title.label("movie"),
+            db.lines.c.line_text.label("text"),
+        )
+        .select_from(
+            db.lines.join(
+                db.characters, db.lines.c.character_id == db.characters.c.character_id
+            ).join(db.movies, db.lines.c.movie_id == db.movies.c.movie_id)
+        )
+        .order_by(db.movies.c.title, db.lines.c.line_id)
+        .limit(limit)
+    )
+    async with db.engine.connect() as conn:
+        return encoding.records((await conn.execute(stmt)).fetchall())
+
+
+async def payloads():
+    # the cached endpoints keep the undecorated function as __wrapped__
+    result = {
+        "/movies/44": await movies.get_movie.__wrapped__(movie_id=44),
+        "/movies/?limit=250": await movies.list_movies.__wrapped__(
+            response=Response(), limit=250, offset=0,
+            sort=movies.movie_sort_options.movie_title, name="", cursor="",
+        ),
+        "/characters/2": await characters.get_character.__wrapped__(id=2),
+        "/characters/?limit=250": await characters.list_characters.__wrapped__(
+            response=Response(), limit=250, offset=0,
+            sort=characters.character_sort_options.character, name="", cursor="",
+        ),
+        "/lines/66": await lines.get_line.__wrapped__(line_id=66),
+        "/lines/?limit=250": await lines_page(250),
+    }
+    await db.dispose()
+    return result
+
+
+def median_time(encode, value, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        encode(value)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'endpoint':<24}{'bytes':>8}{'before us':>12}{'after us':>12}{'speedup':>9}")
+    for path, value in asyncio.run(payloads()).items():
+        assert json.loads(before(value)) == json.loads(after(value))
+        old = median_time(before, value, args.runs)
+        new = median_time(after, value, args.runs)
+        print(
+            f"{path:<24}{len(after(value)):>8}{old * 1e6:>12.1f}{new * 1e6:>12.1f}{old / new:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
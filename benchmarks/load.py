@@ -0,0 +1,109 @@
+"""
+Load test: starts the API under uvicorn and fires requests at it from many
+concurrent clients, reporting throughput and latency percentiles.
+
+    MOVIE_API_BACKEND=memory MOVIE_API_DATA_DIR=$(python -c "from test import corpus; print(corpus.data_dir())") python benchmarks/load.py --requests 2000 --concurrency 200
+
+Point it at a Postgres backend through the usual POSTGRES_* variables to
+measure the database path. Paths are cycled in order.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+DEFAULT_PATHS = [
+    "/movies/44",
+    "/movies/?sort=rating",
+    "/characters/2",
+    "/characters/?sort=number_of_lines",
+    "/lines/66",
+    "/lines/?sort=character",
+    "/conversations/0",
+]
+
+
+async def wait_until_ready(client, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # the first request also loads the memory backend
+            await client.get("/movies/44", timeout=timeout)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def run(base_url, paths, total, concurrency):
+    latencies = []
+    statuses = {}
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(paths[i % len(paths)])
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        await wait_until_ready(client)
+
+        async def worker():
+            while not queue.empty():
+                path = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    status = (await client.get(path)).status_code
+                except httpx.TransportError:
+                    status = "error"
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--port", type=int, default=3055)
+    parser.add_argument("--path", action="append", dest="paths")
+    args = parser.parse_args()
+
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "src.api.server:app",
+            "--port", str(args.port), "--log-level", "warning",
+        ],
+        cwd=ROOT,
+    )
+    try:
+        elapsed, latencies, statuses = asyncio.run(
+            run(
+                f"http://127.0.0.1:{args.port}",
+                args.paths or DEFAULT_PATHS,
+                args.requests,
+                args.concurrency,
+            )
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    print(f"{args.requests} requests, {args.concurrency} concurrent, statuses {statuses}")
+    print(f"  throughput  {args.requests / elapsed:8.1f} req/s")
+    print(f"  p50         {statistics.median(latencies) * 1000:8.1f} ms")
+    print(f"  p99         {latencies[int(len(latencies) * 0.99) - 1] * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
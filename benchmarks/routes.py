@@ -0,0 +1,240 @@
+"""
+Endpoint benchmark: latency, SQL statements and response size of every route.
+
+    python benchmarks/routes.py --runs 50
+    python benchmarks/routes.py --update
+    python benchmarks/routes.py --no-latency
+
+Every route of the API is requested on the local test database: the
+bundled CSVs plus the generated lines fixture. Each case is requested once
+to warm up, then --runs times with the response cache cleared before every
+request, so the timings are of the query path rather than of cache hits.
+
+benchmarks/baseline.json holds the budgets and the baseline of every case.
+A case fails when it runs more statements than its baseline, when its
+response grows by more than bytes_ratio, or when its p50 or p99 exceeds its
+baseline times p50_ratio or p99_ratio plus latency_slack_ms. Latency depends on the
+machine, so --no-latency checks only statements and bytes; --update records
+a new baseline, keeping the budgets. The run exits with status 1 on any
+failure or when a route has no case; CI runs it with --no-latency --runs 5
+after the tests, so statement and size regressions fail the build.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from collections import namedtuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from test import corpus  # noqa: E402
+
+os.environ["MOVIE_API_BACKEND"] = "memory"
+os.environ["MOVIE_API_DATA_DIR"] = corpus.data_dir()
+
+import sqlalchemy  # noqa: E402
+from fastapi.routing import APIRoute  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from src import cache  # noqa: E402
+from src import database as db  # noqa: E402
+from src.api.server import app  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# p99 is close to the slowest of the runs, so it gets more room than p50
+DEFAULT_BUDGETS = {
+    "p50_ratio": 2.0,
+    "p99_ratio": 3.0,
+    "latency_slack_ms": 2.0,
+    "bytes_ratio": 1.1,
+}
+
+# route is the path template the request is served by. Responses whose size
+# depends on what ran before them are marked varies and skip the bytes check.
+Case = namedtuple("Case", "route path method body varies", defaults=("GET", None, False))
+
+CONVERSATION = {
+    "character_1_id": 0,
+    "character_2_id": 1,
+    "lines": [
+        {"character_id": 0, "line_text": "benchmark"},
+        {"character_id": 1, "line_text": "benchmark reply"},
+    ],
+}
+
+CASES = [
+    Case("/", "/"),
+    Case("/movies/{movie_id}", "/movies/44"),
+    Case("/movies:batch", "/movies:batch?ids=" + ",".join(str(i) for i in range(50))),
+    Case("/movies/", "/movies/"),
+    Case("/movies/", "/movies/?sort=rating&limit=250"),
+    Case("/movies/", "/movies/?name=the"),
+    Case("/movies/{movie_id}/graph", "/movies/0/graph"),
+    Case("/movies/{movie_id}/stats", "/movies/0/stats"),
+    Case("/stats/movies", "/stats/movies"),
+    Case("/characters/{id}", "/characters/7421"),
+    Case("/characters:batch", "/characters:batch?ids=" + ",".join(str(i) for i in range(50))),
+    Case("/characters/{id}/network", "/characters/0/network?depth=2"),
+    Case("/characters/", "/characters/"),
+    Case("/characters/", "/characters/?sort=number_of_lines"),
+    Case("/characters/", "/characters/?name=an"),
+    Case("/lines/{line_id}", "/lines/66"),
+    Case("/lines:batch", "/lines:batch?ids=" + ",".join(str(i) for i in range(50))),
+    Case("/lines/", "/lines/"),
+    Case("/lines/", "/lines/?sort=character"),
+    Case("/lines/", "/lines/?text=money&sort=relevance"),
+    Case("/conversations/{conv_id}", "/conversations/0"),
+    Case("/conversations/", "/conversations/?ids=" + ",".join(str(i) for i in range(50))),
+    Case("/movies/{movie_id}/conversations", "/movies/0/conversations"),
+    Case("/export/lines", "/export/lines?movie_id=0"),
+    Case("/export/conversations", "/export/conversations?movie_id=0&format=csv"),
+    Case("/export/characters", "/export/characters?movie_id=0"),
+    Case("/pyversion/", "/pyversion/"),
+    Case("/debug/pool", "/debug/pool", varies=True),
+    Case("/debug/cache", "/debug/cache", varies=True),
+    Case("/debug/queries", "/debug/queries", varies=True),
+    Case("/metrics", "/metrics", varies=True),
+    # writes last, so the reads above see the corpus as loaded
+    Case(
+        "/movies/{movie_id}/conversations/",
+        "/movies/0/conversations/",
+        "POST",
+        json.dumps(CONVERSATION),
+    ),
+    Case(
+        "/movies/{movie_id}/conversations:batch",
+        "/movies/0/conversations:batch",
+        "POST",
+        "\n".join(json.dumps(CONVERSATION) for _ in range(10)),
+    ),
+]
+
+# routes without a case, and why
+EXCLUDED = {
+    "/pkgsize/": "walks site-packages; a debugging aid",
+}
+
+
+def uncovered_routes():
+    "returns the routes of the app that have neither a case nor an exclusion"
+    covered = {case.route for case in CASES} | set(EXCLUDED)
+    return sorted(
+        route.path
+        for route in app.routes
+        if isinstance(route, APIRoute) and route.path not in covered
+    )
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(client, case, runs):
+    "returns the p50 and p99 latency in ms, statements and bytes of a case"
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def request():
+        cache.responses.clear()
+        del statements[:]
+        start = time.perf_counter()
+        response = client.request(case.method, case.path, content=case.body)
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, f"{case.path}: {response.status_code}"
+        return elapsed, len(statements), len(response.content)
+
+    sqlalchemy.event.listen(db.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        # builds whatever the route builds on first use
+        request()
+        samples = [request() for _ in range(runs)]
+    finally:
+        sqlalchemy.event.remove(
+            db.engine.sync_engine, "before_cursor_execute", before_cursor_execute
+        )
+    latencies = [elapsed * 1000 for elapsed, _, _ in samples]
+    return {
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "statements": max(count for _, count, _ in samples),
+        "bytes": samples[-1][2],
+    }
+
+
+def violations(case, result, baseline, budgets, check_latency):
+    "returns what a result exceeds of its baseline and the budgets"
+    found = []
+    if result["statements"] > baseline["statements"]:
+        found.append(f"statements {result['statements']} > {baseline['statements']}")
+    if not case.varies and result["bytes"] > baseline["bytes"] * budgets["bytes_ratio"]:
+        found.append(f"bytes {result['bytes']} > {baseline['bytes']} x {budgets['bytes_ratio']}")
+    if check_latency:
+        for key, ratio in (("p50_ms", "p50_ratio"), ("p99_ms", "p99_ratio")):
+            limit = baseline[key] * budgets[ratio] + budgets["latency_slack_ms"]
+            if result[key] > limit:
+                found.append(f"{key} {result[key]} > {limit:.2f}")
+    return found
+
+
+def case_name(case):
+    return f"{case.method} {case.path}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--update", action="store_true", help="record a new baseline")
+    parser.add_argument("--no-latency", action="store_true", help="skip the latency budgets")
+    args = parser.parse_args()
+
+    uncovered = uncovered_routes()
+    if uncovered:
+        print(f"routes without a benchmark case: {', '.join(uncovered)}")
+        sys.exit(1)
+
+    stored = {"budgets": DEFAULT_BUDGETS, "cases": {}}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, encoding="utf-8") as f:
+            stored = json.load(f)
+    budgets = {**DEFAULT_BUDGETS, **stored.get("budgets", {})}
+
+    results = {}
+    failures = 0
+    print(f"{'case':<52}{'p50 ms':>9}{'p99 ms':>9}{'stmts':>7}{'bytes':>10}")
+    with TestClient(app) as client:
+        for case in CASES:
+            name = case_name(case)
+            result = results[name] = measure(client, case, args.runs)
+            problems = []
+            if not args.update:
+                baseline = stored["cases"].get(name)
+                if baseline is None:
+                    problems = ["no baseline; run with --update"]
+                else:
+                    problems = violations(case, result, baseline, budgets, not args.no_latency)
+            failures += bool(problems)
+            print(
+                f"{name[:51]:<52}{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+                f"{result['statements']:>7}{result['bytes']:>10}"
+                + (f"  FAIL {'; '.join(problems)}" if problems else "")
+            )
+
+    if args.update:
+        with open(BASELINE, "w", encoding="utf-8") as f:
+            json.dump({"budgets": budgets, "cases": results}, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {os.path.relpath(BASELINE, ROOT)}")
+    elif failures:
+        print(f"{failures} of {len(CASES)} cases over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
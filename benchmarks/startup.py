@@ -0,0 +1,71 @@
+"""
+Measures cold start: how long a fresh interpreter takes to import
+src.api.server, to run the app's startup hooks, and then to produce its
+first response.
+
+    MOVIE_API_BACKEND=memory MOVIE_API_DATA_DIR=$(python -c "from test import corpus; print(corpus.data_dir())") python benchmarks/startup.py --runs 5 --path /movies/44
+
+Every run is a new process so nothing is shared between measurements.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import sys
+import time
+
+start = time.perf_counter()
+from src.api.server import app
+imported = time.perf_counter()
+
+from fastapi.testclient import TestClient
+
+loaded = time.perf_counter()
+# entering the client runs the startup hooks, as a server does before serving
+with TestClient(app) as client:
+    ready = time.perf_counter()
+    response = client.get(sys.argv[1])
+    done = time.perf_counter()
+print(imported - start, ready - loaded, done - ready, response.status_code)
+"""
+
+
+def run_once(path):
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, path],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    return float(output[0]), float(output[1]), float(output[2]), int(output[3])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/movies/44")
+    args = parser.parse_args()
+
+    imports, startups, first_responses = [], [], []
+    for _ in range(args.runs):
+        import_time, startup_time, response_time, status = run_once(args.path)
+        imports.append(import_time)
+        startups.append(startup_time)
+        first_responses.append(response_time)
+
+    print(f"GET {args.path} -> {status} over {args.runs} runs (median)")
+    print(f"  import src.api.server  {statistics.median(imports) * 1000:8.1f} ms")
+    print(f"  startup hooks          {statistics.median(startups) * 1000:8.1f} ms")
+    print(f"  first response         {statistics.median(first_responses) * 1000:8.1f} ms")
+    total = [sum(times) for times in zip(imports, startups, first_responses)]
+    print(f"  import to response     {statistics.median(total) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
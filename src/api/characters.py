@@ -1,96 +1,53 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from enum import Enum
-from collections import Counter
 import sqlalchemy
 from sqlalchemy import desc, func, select
 
 from src import database as db
+from src import cache
+from src import encoding
+from src import graph
+from src import multiget
+from src import pagination
 from fastapi.params import Query
 
 
 router = APIRouter()
 
 
-def get_num_lines_convo(character1_id, character2_id):
-    "returns the number of lines between the same two characters"
-    stmt = sqlalchemy.select(
-        sqlalchemy.func.count(db.conversations.c.conversation_id)
-    ).where(
-         sqlalchemy.or_((db.conversations.c.character1_id == character1_id and db.conversations.c.character2_id == character2_id),
-        (db.conversations.c.character1_id == character2_id and db.conversations.c.character2_id == character1_id))
-    )
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        return result.scalar()
-    
-def get_num_lines_character(character_id:int):
-    "returns the number of lines a character has"
-    stmt = sqlalchemy.select(
-        sqlalchemy.func.count(db.lines.c.line_id)
-    ).where(
-        db.lines.c.character_id == character_id
-    )
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        return result.scalar()
-   
-
 def get_top_convos(id: int):
     """
-    c_id = character.id
-    movie_id = character.movie_id
-    all_convs = filter(
-        lambda conv: conv.movie_id == movie_id
-        and (conv.c1_id == c_id or conv.c2_id == c_id),
-        db.conversations.values(),
-    )
-    line_counts = Counter()
-
-    for conv in all_convs:
-        other_id = conv.c2_id if conv.c1_id == c_id else conv.c1_id
-        line_counts[other_id] += conv.num_lines
+    returns a subquery ranking everyone the character shares a conversation
+    with by the number of lines in those conversations
+    """
+    partner_id = sqlalchemy.case(
+        (db.conversations.c.character1_id == id, db.conversations.c.character2_id),
+        else_=db.conversations.c.character1_id,
+    ).label("partner_id")
 
-    return line_counts.most_common()
- """
-    stmt = (
+    return (
         sqlalchemy.select(
-            db.conversations.c.character1_id,
-            db.conversations.c.character2_id,
-            db.conversations.c.movie_id,
+            partner_id,
+            sqlalchemy.func.count(db.lines.c.line_id).label("number_of_lines_together"),
+        )
+        .select_from(
+            db.conversations.join(
+                db.lines, db.conversations.c.conversation_id == db.lines.c.conversation_id
+            )
         )
         .where(
             sqlalchemy.or_(
                 db.conversations.c.character1_id == id, db.conversations.c.character2_id == id
             )
         )
+        .group_by(partner_id)
+        .subquery("top_convos")
     )
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt).fetchall()
-        line_counts = Counter()
-
-        for conv in result:
-            other_id = conv.character2_id if conv.character1_id == id else conv.character1_id
-            line_counts[other_id] += get_num_lines_convo(id, other_id)
-
-        return line_counts.most_common()
-
-
-        """
-            top_conversations": (
-                {
-                    "character_id": other_id,
-                    "character": db.characters.other_id.name,
-                    "gender": db.characters.other_id.gender,
-                    "number_of_lines_together": lines,
-                }
-                for other_id, lines in get_top_convos(id)
-            ),
-            """
-
 
 @router.get("/characters/{id}", tags=["characters"])
-def get_character(id: int):
+@cache.cached("get_character", ttl=300, tags=lambda p: [("character", p["id"])])
+async def get_character(id: int):
     """
     This endpoint returns a single character by its identifier. For each character
     it returns:
@@ -111,47 +68,205 @@ def get_character(id: int):
       originally queried character.
     """
     top_convos = get_top_convos(id)
+    partner = db.characters.alias("partner")
 
-
+    # the character and its ranked partners come back in one round trip, one
+    # row per partner (or a single row with no partner)
     stmt = (
         sqlalchemy.select(
-            db.characters.c.character_id, 
-            db.characters.c.name, 
+            db.characters.c.character_id,
+            db.characters.c.name,
             db.movies.c.title,
-            db.characters.c.gender
-        ).select_from(
-            sqlalchemy.join(db.characters, db.movies, db.characters.c.movie_id == db.movies.c.movie_id)
-        ).where(
-            db.characters.c.character_id == id
+            db.characters.c.gender,
+            partner.c.character_id.label("partner_id"),
+            partner.c.name.label("partner_name"),
+            partner.c.gender.label("partner_gender"),
+            top_convos.c.number_of_lines_together,
+        )
+        .select_from(
+            db.characters.join(
+                db.movies, db.characters.c.movie_id == db.movies.c.movie_id
+            )
+            .outerjoin(top_convos, sqlalchemy.true())
+            .outerjoin(partner, partner.c.character_id == top_convos.c.partner_id)
+        )
+        .where(db.characters.c.character_id == id)
+        .order_by(
+            sqlalchemy.desc(top_convos.c.number_of_lines_together),
+            top_convos.c.partner_id,
         )
     )
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        if result.rowcount == 0:
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
+        if len(result) == 0:
             raise HTTPException(status_code=404, detail="character not found")
         json = {
-            "character_id": result.character_id,
-            "character": result.name,
-            "movie": result.title,
-            "gender": result.gender,
-            "top_conversations": (
+            "character_id": result[0].character_id,
+            "character": result[0].name,
+            "movie": result[0].title,
+            "gender": result[0].gender,
+            "top_conversations": [
                 {
-                    "character_id": other_id,
-                    "character": "TODO",
-                    "gender": "TODO",
-                    "number_of_lines_together": lines,
+                    "character_id": row.partner_id,
+                    "character": row.partner_name,
+                    "gender": row.partner_gender,
+                    "number_of_lines_together": row.number_of_lines_together,
                 }
-                for other_id, lines in top_convos
-            ),
+                for row in result
+                if row.partner_id is not None
+            ],
+        }
 
+    return json
 
-         
 
-        }
+@router.get("/characters:batch", tags=["characters"])
+@cache.cached(
+    "get_characters",
+    ttl=300,
+    tags=lambda p: [("character", id) for id in multiget.parse_ids(p["ids"])],
+)
+async def get_characters(ids: str):
+    """
+    This endpoint returns many characters at once. `ids` is a comma separated
+    list of up to 100 character ids. It returns:
+    * `results`: the characters found, in the order requested, each as returned
+      by `/characters/{character_id}`.
+    * `missing`: the requested ids that match no character.
+    """
+    character_ids = multiget.parse_ids(ids)
+
+    # conversations seen from each side, so every requested character gets
+    # its partners from one grouped join
+    sides = sqlalchemy.union_all(
+        sqlalchemy.select(
+            db.conversations.c.character1_id.label("character_id"),
+            db.conversations.c.character2_id.label("partner_id"),
+            db.conversations.c.conversation_id,
+        ).where(multiget.any_of(db.conversations.c.character1_id, character_ids)),
+        sqlalchemy.select(
+            db.conversations.c.character2_id.label("character_id"),
+            db.conversations.c.character1_id.label("partner_id"),
+            db.conversations.c.conversation_id,
+        ).where(multiget.any_of(db.conversations.c.character2_id, character_ids)),
+    ).subquery("sides")
+    top_convos = (
+        sqlalchemy.select(
+            sides.c.character_id,
+            sides.c.partner_id,
+            sqlalchemy.func.count(db.lines.c.line_id).label("number_of_lines_together"),
+        )
+        .select_from(
+            sides.join(db.lines, db.lines.c.conversation_id == sides.c.conversation_id)
+        )
+        .group_by(sides.c.character_id, sides.c.partner_id)
+        .subquery("top_convos")
+    )
+    partner = db.characters.alias("partner")
+
+    stmt = (
+        sqlalchemy.select(
+            db.characters.c.character_id,
+            db.characters.c.name,
+            db.movies.c.title,
+            db.characters.c.gender,
+            partner.c.character_id.label("partner_id"),
+            partner.c.name.label("partner_name"),
+            partner.c.gender.label("partner_gender"),
+            top_convos.c.number_of_lines_together,
+        )
+        .select_from(
+            db.characters.join(db.movies, db.characters.c.movie_id == db.movies.c.movie_id)
+            .outerjoin(
+                top_convos, top_convos.c.character_id == db.characters.c.character_id
+            )
+            .outerjoin(partner, partner.c.character_id == top_convos.c.partner_id)
+        )
+        .where(multiget.any_of(db.characters.c.character_id, character_ids))
+        .order_by(
+            db.characters.c.character_id,
+            sqlalchemy.desc(top_convos.c.number_of_lines_together),
+            top_convos.c.partner_id,
+        )
+    )
+
+    async with db.engine.connect() as conn:
+        result = await conn.execute(stmt)
+        found = {}
+        for row in result:
+            if row.character_id not in found:
+                found[row.character_id] = {
+                    "character_id": row.character_id,
+                    "character": row.name,
+                    "movie": row.title,
+                    "gender": row.gender,
+                    "top_conversations": [],
+                }
+            if row.partner_id is not None:
+                found[row.character_id]["top_conversations"].append(
+                    {
+                        "character_id": row.partner_id,
+                        "character": row.partner_name,
+                        "gender": row.partner_gender,
+                        "number_of_lines_together": row.number_of_lines_together,
+                    }
+                )
+
+    return multiget.in_order(character_ids, found)
+
+
+@router.get("/characters/{id}/network", tags=["characters"])
+async def get_character_network(id: int, depth: int = Query(1, ge=1, le=3)):
+    """
+    This endpoint returns the characters a character talks to, directly or
+    through others, up to `depth` conversations away. It returns:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `characters`: Everyone in the network, ordered by distance then id, each
+      with its `character_id`, `character` name and `distance` in conversations
+      (0 for the character itself).
+    * `edges`: The pairs of characters in the network that talk to each other,
+      each with `character_1_id`, `character_2_id`, `number_of_lines_together`
+      and `number_of_conversations`.
+
+    The network comes from an in-process interaction graph, so its cost grows
+    with the number of characters reached rather than with the corpus.
+    """
+    distances, edges = (await graph.get_graph()).network(id, depth)
+
+    async with db.engine.connect() as conn:
+        result = (
+            await conn.execute(
+                sqlalchemy.select(db.characters.c.character_id, db.characters.c.name).where(
+                    db.characters.c.character_id.in_(list(distances))
+                )
+            )
+        ).fetchall()
+    names = {row.character_id: row.name for row in result}
+    if id not in names:
+        raise HTTPException(status_code=404, detail="character not found")
+
+    return {
+        "character_id": id,
+        "character": names[id],
+        "characters": [
+            {"character_id": character_id, "character": names.get(character_id), "distance": distance}
+            for character_id, distance in sorted(
+                distances.items(), key=lambda item: (item[1], item[0])
+            )
+        ],
+        "edges": [
+            {
+                "character_1_id": a,
+                "character_2_id": b,
+                "number_of_lines_together": lines,
+                "number_of_conversations": conversations,
+            }
+            for a, b, lines, conversations in edges
+        ],
+    }
 
-    return json
-            
 
 class character_sort_options(str, Enum):
     character = "character"
@@ -160,11 +275,14 @@ class character_sort_options(str, Enum):
 
 
 @router.get("/characters/", tags=["characters"])
-def list_characters(
+@cache.cached("list_characters", ttl=60, tags=lambda p: [("characters",)])
+async def list_characters(
+    response: Response,
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: character_sort_options = character_sort_options.character,
+    cursor: str = "",
 ):
     """
     This endpoint returns a list of characters. For each character it returns:
@@ -186,51 +304,51 @@ def list_characters(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    For deep paging pass the `X-Next-Cursor` response header of the previous page
+    as the `cursor` query parameter instead of increasing `offset`. The header is
+    omitted on the last page.
     """
     if sort == character_sort_options.character:
-        sort_by = db.characters.c.name
+        keys = [(db.characters.c.name, False, "character")]
     elif sort == character_sort_options.movie:
-        sort_by = db.movies.c.title
+        keys = [(db.movies.c.title, False, "movie")]
     elif sort == character_sort_options.number_of_lines:
-        sort_by = sqlalchemy.desc("number_of_lines")
+        keys = [(db.character_stats.c.num_lines, True, "number_of_lines")]
     
     else:
         raise HTTPException(status_code=400, detail="Invalid sort option")
-    stmt = (
+    keys.append((db.characters.c.character_id, False, "character_id"))
+
+    stmt = pagination.paginate(
           
           sqlalchemy.select(
               db.characters.c.character_id,
-              db.characters.c.name,
-              db.movies.c.title,  
-              sqlalchemy.func.count(db.lines.c.line_id).label("number_of_lines")
+              db.characters.c.name.label("character"),
+              db.movies.c.title.label("movie"),
+              db.character_stats.c.num_lines.label("number_of_lines")
               )
           .select_from(
             sqlalchemy.join(db.characters,db.movies, db.movies.c.movie_id == db.characters.c.movie_id))
-            .join(db.lines, db.characters.c.character_id == db.lines.c.character_id)
-            .group_by(
-              db.characters.c.character_id,
-              db.movies.c.title, 
-          )
-          .order_by(sort_by)
-          .limit(limit)
-          .offset(offset)
-
+            .join(db.character_stats, db.characters.c.character_id == db.character_stats.c.character_id)
+            .where(db.character_stats.c.num_lines > 0),
+          keys,
+          cursor,
+          limit,
+          offset,
       )
 
     if name != "":
         stmt = stmt.where(db.characters.c.name.ilike(f"%{name}%"))
 
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt).fetchall()
-        return [
-            {
-                "character_id": row.character_id,
-                "character": row.name,
-                "movie": row.title,
-                "number_of_lines": row.number_of_lines,
-            }
-            for row in result
-        ]
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
+
+    next_cursor = pagination.next_cursor(result, keys, limit)
+    if next_cursor is not None:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    # the columns are labelled with the response field names
+    return encoding.records(result)
 
 
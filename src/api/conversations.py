@@ -1,11 +1,13 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from src import database as db
-from pydantic import BaseModel
+from src import cache, graph, multiget, search, stats
+from src.streaming import iter_json_items
+from pydantic import BaseModel, ValidationError
 from typing import List
 from datetime import datetime
 from collections import Counter
 import sqlalchemy
-from sqlalchemy import desc, func, select
+from sqlalchemy import desc, select
 
 
 # FastAPI is inferring what the request body should look like
@@ -23,57 +25,109 @@ class ConversationJson(BaseModel):
 
 router = APIRouter()
 
+def transcript_query():
+    "returns every line with its speaker and movie, in transcript order"
+    return (
+        sqlalchemy.select(
+            db.lines.c.conversation_id,
+            db.movies.c.title.label("movie"),
+            db.characters.c.name.label("character"),
+            db.lines.c.line_text.label("line"),
+        )
+        .select_from(
+            db.lines.join(
+                db.conversations,
+                db.conversations.c.conversation_id == db.lines.c.conversation_id,
+            )
+            .join(db.movies, db.conversations.c.movie_id == db.movies.c.movie_id)
+            .join(db.characters, db.lines.c.character_id == db.characters.c.character_id)
+        )
+        .order_by(db.lines.c.conversation_id, db.lines.c.line_sort)
+    )
+
+
+def transcripts(rows):
+    "groups the rows of a transcript query into conversations in one pass"
+    conversations = []
+    current = None
+    for conversation_id, movie, character, line in rows:
+        if current is None or current["conv_id"] != conversation_id:
+            current = {"conv_id": conversation_id, "movie": movie, "conversation": []}
+            conversations.append(current)
+        current["conversation"].append({"character": character, "line": line})
+    return conversations
+
+
+@router.get("/conversations/", tags=["conversations"])
+@cache.cached(
+    "list_conversations",
+    ttl=3600,
+    # the missing ids too, so adding their conversations drops the entry
+    tags=lambda p: [("conversation", id) for id in multiget.parse_ids(p["ids"])],
+)
+async def list_conversations(ids: str):
+    """
+    This endpoint returns many conversations at once. `ids` is a comma
+    separated list of up to 100 conversation ids. It returns:
+    * `results`: the conversations found, in the order requested, each as
+      returned by `/conversations/{conv_id}`.
+    * `missing`: the requested ids that match no conversation.
+    """
+    conversation_ids = multiget.parse_ids(ids)
+    stmt = transcript_query().where(
+        multiget.any_of(db.lines.c.conversation_id, conversation_ids)
+    )
+
+    async with db.engine.connect() as conn:
+        result = await conn.execute(stmt)
+        found = {conversation["conv_id"]: conversation for conversation in transcripts(result)}
+
+    return multiget.in_order(conversation_ids, found)
+
+
 @router.get("/conversations/{conv_id}", tags=["conversations"])
-def get_conversation(conv_id: int):
+@cache.cached("get_conversation", ttl=3600)
+async def get_conversation(conv_id: int):
     """
     This endpoint returns a single conversation by its identifier. For each conversation it returns:
     * `conv_id`: the internal id of the conversation.
-    * `character`: The name of the character that said the line.
-    * `movie`: The title of the movie the line is from.
-    * `comversation`: The text of the conversation, including all lines that have the same conv_id.
-    """
-    stmt = sqlalchemy.select(
-        db.conversations.c.conversation_id,
-        db.characters.c.name.label("character"),
-        db.movies.c.title.label("movie"),
-        db.lines.c.line_text.label("line"),
-
-    ).select_from(
-        db.conversations.join(
-            db.movies, db.conversations.c.movie_id == db.movies.c.movie_id
-        )
-        .join(
-            db.lines, db.conversations.c.conversation_id == db.lines.c.conversation_id
-        )
-    ).join(
-            db.characters, db.lines.c.character_id == db.characters.c.character_id
-        ).where(db.conversations.c.conversation_id == conv_id)
+    * `movie`: The title of the movie the conversation is from.
+    * `conversation`: The lines of the conversation in order, each with the
+      `character` that said it and the text of the `line`.
+    """
+    stmt = transcript_query().where(db.lines.c.conversation_id == conv_id)
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        convos = conn.execute(stmt)
-        if result.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Conversation not found")
+    async with db.engine.connect() as conn:
+        conversations = transcripts(await conn.execute(stmt))
 
-        convo = []
-        for row in convos:
-            line = {}
-            line["character"] = row.character
-            line["line"] = row.line
-            convo.append(line)
+    if len(conversations) == 0:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conversations[0]
 
-        json= {}
-        for row in result:
-            json["conv_id"] = row.conversation_id
-            json["movie"] = row.movie
-            json["conversation"] = convo
 
-    return json
+@router.get("/movies/{movie_id}/conversations", tags=["movies"])
+@cache.cached("list_movie_conversations", ttl=300, tags=lambda p: [("movie", p["movie_id"])])
+async def list_movie_conversations(movie_id: int):
+    """
+    This endpoint returns every conversation of a movie, ordered by
+    `conv_id`, each as returned by `/conversations/{conv_id}`.
+    """
+    stmt = transcript_query().where(db.conversations.c.movie_id == movie_id)
+
+    async with db.engine.connect() as conn:
+        conversations = transcripts(await conn.execute(stmt))
+        if len(conversations) == 0:
+            movie = await conn.execute(
+                sqlalchemy.select(db.movies.c.movie_id).where(db.movies.c.movie_id == movie_id)
+            )
+            if movie.first() is None:
+                raise HTTPException(status_code=404, detail="Movie not found")
 
+    return conversations
 
 
 @router.post("/movies/{movie_id}/conversations/", tags=["movies"])
-def add_conversation(movie_id: int, conversation: ConversationJson):
+async def add_conversation(movie_id: int, conversation: ConversationJson):
     """
     This endpoint adds a conversation to a movie. The conversation is represented
     by the two characters involved in the conversation and a series of lines between
@@ -87,103 +141,281 @@ def add_conversation(movie_id: int, conversation: ConversationJson):
     request body.
 
     The endpoint returns the id of the resulting conversation that was created.
+    """
 
-    stmt = sqlalchemy.select(
-        db.movies.c.movie_id,
-        db.characters.c.name.label("character"),
-    ).select_from(db.movies.join(db.characters, db.movies.c.movie_id == db.characters.c.movie_id)).where(db.movies.c.movie_id == movie_id and
-            db.characters.c.character_id == conversation.character_1_id or
-            db.characters.c.character_id == conversation.character_2_id)
+    error = conversation_error(conversation)
+    if error is not None:
+        raise HTTPException(status_code=404, detail=error)
+
+    # validation, both inserts and the statistics update share one transaction
+    async with db.engine.begin() as conn:
+        #check that the movie exists and both characters are in it
+        stmt = sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.characters.c.character_id,
+        ).select_from(
+            db.movies.outerjoin(
+                db.characters,
+                sqlalchemy.and_(
+                    db.characters.c.movie_id == db.movies.c.movie_id,
+                    db.characters.c.character_id.in_(
+                        [conversation.character_1_id, conversation.character_2_id]
+                    ),
+                ),
+            )
+        ).where(db.movies.c.movie_id == movie_id)
+        result = (await conn.execute(stmt)).fetchall()
+        if len(result) == 0:
+            raise HTTPException(status_code=404, detail="Movie not found")
+        if len({row.character_id for row in result if row.character_id is not None}) < 2:
+            raise HTTPException(status_code=404, detail="Characters not found in movie")
 
+        conversation_id, line_ids = await insert_conversation(conn, movie_id, conversation)
 
-    """
+    search.record_lines(
+        (line_id, movie_id, line.line_text)
+        for line_id, line in zip(line_ids, conversation.lines)
+    )
+    graph.record_conversations(
+        [(conversation.character_1_id, conversation.character_2_id, len(conversation.lines))]
+    )
+    invalidate_cache(movie_id, [conversation], [(conversation_id, line_ids)])
 
-    #check if movie exists
-    stmt = sqlalchemy.select(db.movies.c.movie_id).where(db.movies.c.movie_id == movie_id)
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        if result.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Movie not found")
-    
+    return {"conversation_id": conversation_id}
+
+
+def invalidate_cache(movie_id: int, conversations: List[ConversationJson], inserted):
+    """
+    drops the cached responses that new conversations in a movie make stale.
+    inserted holds the conversation id and line ids of each, as returned by
+    insert_conversations.
+    """
+    character_ids = set()
+    for conversation in conversations:
+        character_ids.update((conversation.character_1_id, conversation.character_2_id))
+    cache.responses.invalidate(
+        ("movie", movie_id),
+        ("movies",),
+        ("characters",),
+        *(("character", character_id) for character_id in character_ids),
+        *(("conversation", conversation_id) for conversation_id, _ in inserted),
+        *(("line", line_id) for _, line_ids in inserted for line_id in line_ids),
+    )
+
+
+def conversation_error(conversation: ConversationJson):
+    "returns why a conversation is invalid regardless of its movie, or None"
     #check if characters are the same
     if conversation.character_1_id == conversation.character_2_id:
-        raise HTTPException(status_code=404, detail="Characters cannot be the same")
-    
-    #check if characters exist in movie
-    stmt = sqlalchemy.select(
-        db.movies.c.movie_id,
-        db.characters.c.name.label("character"),
-    ).select_from(db.movies.join(db.characters, db.movies.c.movie_id == db.characters.c.movie_id)).where(db.movies.c.movie_id == movie_id and
-            (db.characters.c.character_id == conversation.character_1_id or
-            db.characters.c.character_id == conversation.character_2_id))
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        if result.rowcount < 2:
-            print(result.rowcount == 2)
-            raise HTTPException(status_code=404, detail="Characters not found in movie")
-        
+        return "Characters cannot be the same"
+
     #check if lines match characters
     for line in conversation.lines:
         if line.character_id != conversation.character_1_id and line.character_id != conversation.character_2_id:
-            raise HTTPException(status_code=404, detail="Character does not match line")
-
-    #get the next conversation id and line id
-    with db.engine.connect() as conn:
-        convo_num_ids = conn.execute(sqlalchemy.select(func.max(db.conversations.c.conversation_id)))
-        line_num_ids = conn.execute(sqlalchemy.select(func.max(db.lines.c.line_id)))
-        for row in convo_num_ids:
-            conversation_id = row[0] + 1
-        for row in line_num_ids:
-            line_id = row[0] + 1
-        
-    #upload new conversation 
-    with db.engine.begin() as conn:
-        conn.execute(
-            sqlalchemy.insert(db.conversations),
-            [
-                {"conversation_id": conversation_id,
+            return "Character does not match line"
+    return None
+
+
+# conversations inserted per transaction by the batch endpoint
+BATCH_SIZE = 500
+
+
+@router.post("/movies/{movie_id}/conversations:batch", tags=["movies"])
+async def add_conversations(movie_id: int, request: Request):
+    """
+    This endpoint adds many conversations to a movie at once. The request body
+    is either newline-delimited JSON with one conversation per line or a JSON
+    array of conversations, each shaped like the body of
+    `/movies/{movie_id}/conversations/`. The body is read as it arrives, so
+    uploads of any size are accepted.
+
+    Every conversation is validated the same way as for the single endpoint.
+    Valid conversations are inserted in bulk, a few hundred per transaction;
+    invalid ones are skipped.
+
+    The endpoint returns:
+    * `created`: the number of conversations that were created.
+    * `failed`: the number of conversations that were rejected.
+    * `results`: one entry per conversation in request order, holding its
+      `index` and either its `conversation_id` or the `error` that rejected it.
+
+    Each transaction commits on its own, so a failure partway through leaves
+    the earlier ones in place. The endpoint then stops reading and answers
+    500 with the same fields under `detail`, covering what it got through:
+    the conversations with a `conversation_id` were committed, and any
+    conversation without one may be sent again.
+    """
+    # one lookup validates membership for the whole batch
+    async with db.engine.connect() as conn:
+        result = (
+            await conn.execute(
+                sqlalchemy.select(db.movies.c.movie_id, db.characters.c.character_id)
+                .select_from(
+                    db.movies.outerjoin(
+                        db.characters, db.characters.c.movie_id == db.movies.c.movie_id
+                    )
+                )
+                .where(db.movies.c.movie_id == movie_id)
+            )
+        ).fetchall()
+    if len(result) == 0:
+        raise HTTPException(status_code=404, detail="Movie not found")
+    movie_characters = {row.character_id for row in result}
+
+    results = []
+    pending = []
+
+    async def flush():
+        try:
+            async with db.engine.begin() as conn:
+                inserted = await insert_conversations(conn, movie_id, [c for _, c in pending])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=summary(results)) from e
+        new_lines = []
+        for (index, conversation), (conversation_id, line_ids) in zip(pending, inserted):
+            results.append({"index": index, "conversation_id": conversation_id})
+            new_lines.extend(
+                (line_id, movie_id, line.line_text)
+                for line_id, line in zip(line_ids, conversation.lines)
+            )
+        search.record_lines(new_lines)
+        graph.record_conversations(
+            (conversation.character_1_id, conversation.character_2_id, len(conversation.lines))
+            for _, conversation in pending
+        )
+        invalidate_cache(movie_id, [conversation for _, conversation in pending], inserted)
+        pending.clear()
+
+    index = 0
+    async for item, error in iter_json_items(request.stream()):
+        if error is None:
+            try:
+                conversation = ConversationJson.parse_obj(item)
+            except ValidationError as e:
+                error = "; ".join(
+                    f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()
+                )
+        if error is None:
+            error = conversation_error(conversation)
+        if error is None and not {
+            conversation.character_1_id, conversation.character_2_id
+        } <= movie_characters:
+            error = "Characters not found in movie"
+
+        if error is None:
+            pending.append((index, conversation))
+            if len(pending) >= BATCH_SIZE:
+                await flush()
+        else:
+            results.append({"index": index, "error": error})
+        index += 1
+
+    if pending:
+        await flush()
+
+    return summary(results)
+
+
+def summary(results):
+    "returns the response of the batch endpoint for its results so far"
+    results.sort(key=lambda entry: entry["index"])
+    created = sum(1 for entry in results if "conversation_id" in entry)
+    return {"created": created, "failed": len(results) - created, "results": results}
+
+
+async def insert_conversations(conn, movie_id: int, conversations: List[ConversationJson]):
+    """
+    inserts validated conversations and their lines in bulk. Ids are reserved
+    up front so every table gets a single COPY or executemany, and the result
+    is a (conversation_id, line_ids) pair per conversation in input order.
+    """
+    conversation_ids = await db.allocate_ids(
+        conn, db.conversations.c.conversation_id, len(conversations)
+    )
+    line_ids = await db.allocate_ids(
+        conn, db.lines.c.line_id, sum(len(c.lines) for c in conversations)
+    )
+
+    conversation_rows = []
+    line_rows = []
+    inserted = []
+    next_line = 0
+    for conversation_id, conversation in zip(conversation_ids, conversations):
+        conversation_rows.append(
+            {
+                "conversation_id": conversation_id,
                 "character1_id": conversation.character_1_id,
                 "character2_id": conversation.character_2_id,
-                "movie_id": movie_id,},
-            ],
-        
-     )
-        
-    #upload new lines
-    line_sort = 1
-    for line in conversation.lines:
-        with db.engine.begin() as conn:
-            conn.execute(
-                sqlalchemy.insert(db.lines),
-                [
-                    {"line_id": line_id,
+                "movie_id": movie_id,
+            }
+        )
+        ids = line_ids[next_line:next_line + len(conversation.lines)]
+        next_line += len(conversation.lines)
+        for line_id, (line_sort, line) in zip(ids, enumerate(conversation.lines, start=1)):
+            line_rows.append(
+                {
+                    "line_id": line_id,
                     "character_id": line.character_id,
                     "movie_id": movie_id,
                     "conversation_id": conversation_id,
                     "line_sort": line_sort,
                     "line_text": line.line_text,
-                    },
-                ])
-        line_sort += 1
-        line_id += 1
-        
-    return {"conversation_id": conversation_id}
-
-
-
-  
-    
-    
-
-    
-  
-
-
-
-
-
-    
-  
-
-
-
+                }
+            )
+        inserted.append((conversation_id, ids))
+
+    await db.copy_rows(conn, db.conversations, conversation_rows)
+    await db.copy_rows(conn, db.lines, line_rows)
+    await conn.run_sync(
+        stats.record_conversation,
+        movie_id,
+        [row["character_id"] for row in line_rows],
+        len(conversations),
+    )
+    return inserted
+
+
+async def insert_conversation(conn, movie_id: int, conversation: ConversationJson):
+    """
+    inserts a validated conversation and its lines, letting the database assign
+    the ids. Returns the conversation id and the line ids in line order.
+    """
+    conversation_id = (
+        await conn.execute(
+            sqlalchemy.insert(db.conversations)
+            .values(
+                character1_id=conversation.character_1_id,
+                character2_id=conversation.character_2_id,
+                movie_id=movie_id,
+            )
+            .returning(db.conversations.c.conversation_id)
+        )
+    ).scalar_one()
+
+    line_ids = []
+    if conversation.lines:
+        # one multi-row INSERT; line_sort follows the order of the request body
+        result = await conn.execute(
+            sqlalchemy.insert(db.lines)
+            .values(
+                [
+                    {
+                        "character_id": line.character_id,
+                        "movie_id": movie_id,
+                        "conversation_id": conversation_id,
+                        "line_sort": line_sort,
+                        "line_text": line.line_text,
+                    }
+                    for line_sort, line in enumerate(conversation.lines, start=1)
+                ]
+            )
+            .returning(db.lines.c.line_id, db.lines.c.line_sort)
+        )
+        line_ids = [row.line_id for row in sorted(result, key=lambda row: row.line_sort)]
+
+    await conn.run_sync(
+        stats.record_conversation,
+        movie_id,
+        [line.character_id for line in conversation.lines],
+    )
+    return conversation_id, line_ids
@@ -0,0 +1,114 @@
+from enum import Enum
+from typing import Optional
+
+import sqlalchemy
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+
+from src import database as db
+from src import streaming
+
+router = APIRouter()
+
+# rows read per query, and encoded per chunk of the response
+BATCH_SIZE = 1000
+
+
+class export_format(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {
+    export_format.ndjson: "application/x-ndjson",
+    export_format.csv: "text/csv",
+}
+
+
+def export(name: str, table, key, movie_id: Optional[int], format: export_format):
+    """
+    streams every row of table in key order, optionally only those of one
+    movie. Each batch is its own keyset query, and the connection goes back
+    before the batch is sent, so a slow client doesn't hold it (or, on the
+    memory backend, the lock every other request waits for) for the whole
+    download. Memory use doesn't depend on the size of the table.
+    """
+    stmt = sqlalchemy.select(table).order_by(key).limit(BATCH_SIZE)
+    if movie_id is not None:
+        stmt = stmt.where(table.c.movie_id == movie_id)
+
+    async def chunks():
+        header = [column.name for column in table.columns]
+        last = None
+        while True:
+            batch = stmt if last is None else stmt.where(key > last)
+            async with db.engine.connect() as conn:
+                rows = (await conn.execute(batch)).all()
+            if format == export_format.csv:
+                if rows or header is not None:
+                    yield streaming.csv_chunk(rows, header)
+                header = None
+            elif rows:
+                yield streaming.ndjson_chunk(rows)
+            if len(rows) < BATCH_SIZE:
+                return
+            last = rows[-1]._mapping[key]
+
+    return StreamingResponse(
+        chunks(),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{format.value}"'},
+    )
+
+
+@router.get("/export/lines", tags=["export"])
+def export_lines(movie_id: Optional[int] = None, format: export_format = export_format.ndjson):
+    """
+    This endpoint streams every line, ordered by `line_id`. For each line it
+    returns:
+    * `line_id`: the internal id of the line.
+    * `character_id`: the internal id of the character that said the line.
+    * `movie_id`: the internal id of the movie the line is from.
+    * `conversation_id`: the internal id of the conversation the line is in.
+    * `line_sort`: the position of the line in its conversation.
+    * `line_text`: The text of the line.
+
+    Pass `movie_id` to export a single movie. `format` is `ndjson` (one JSON
+    object per line) or `csv` (with a header row).
+    """
+    return export("lines", db.lines, db.lines.c.line_id, movie_id, format)
+
+
+@router.get("/export/conversations", tags=["export"])
+def export_conversations(movie_id: Optional[int] = None, format: export_format = export_format.ndjson):
+    """
+    This endpoint streams every conversation, ordered by `conversation_id`. For
+    each conversation it returns:
+    * `conversation_id`: the internal id of the conversation.
+    * `character1_id`: the internal id of the first character.
+    * `character2_id`: the internal id of the second character.
+    * `movie_id`: the internal id of the movie the conversation is from.
+
+    Pass `movie_id` to export a single movie. `format` is `ndjson` (one JSON
+    object per line) or `csv` (with a header row).
+    """
+    return export(
+        "conversations", db.conversations, db.conversations.c.conversation_id, movie_id, format
+    )
+
+
+@router.get("/export/characters", tags=["export"])
+def export_characters(movie_id: Optional[int] = None, format: export_format = export_format.ndjson):
+    """
+    This endpoint streams every character, ordered by `character_id`. For each
+    character it returns:
+    * `character_id`: the internal id of the character.
+    * `name`: The name of the character.
+    * `movie_id`: the internal id of the movie the character is from.
+    * `gender`: The gender of the character.
+    * `age`: The age of the character.
+
+    Pass `movie_id` to export a single movie. `format` is `ndjson` (one JSON
+    object per line) or `csv` (with a header row).
+    """
+    return export("characters", db.characters, db.characters.c.character_id, movie_id, format)
@@ -1,6 +1,11 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from enum import Enum
 from src import database as db
+from src import cache
+from src import encoding
+from src import multiget
+from src import pagination
+from src import search
 from fastapi.params import Query
 from collections import Counter
 import sqlalchemy
@@ -10,7 +15,8 @@ from sqlalchemy import desc, func, select
 router = APIRouter()
 
 @router.get("/lines/{line_id}", tags=["lines"])
-def get_line(line_id: int):
+@cache.cached("get_line", ttl=3600)
+async def get_line(line_id: int):
     """
     This endpoint returns a single line by its identifier. For each line it returns:
     * `line_id`: the internal id of the line.
@@ -35,19 +41,48 @@ def get_line(line_id: int):
         )
     ).where(db.lines.c.line_id == line_id)
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        if result.rowcount == 0:
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
+        if len(result) == 0:
             raise HTTPException(status_code=404, detail="Line not found")
-        json = {}
-        for row in result:
-            json["line_id"] = row.line_id
-            json["character_id"] = row.character_id
-            json["character"] = row.character
-            json["movie_id"] = row.movie_id
-            json["movie"] = row.movie
-            json["text"] = row.text
-        return json
+        return encoding.records(result)[0]
+
+
+@router.get("/lines:batch", tags=["lines"])
+@cache.cached(
+    "get_lines",
+    ttl=3600,
+    # the missing ids too, so adding their lines drops the entry
+    tags=lambda p: [("line", id) for id in multiget.parse_ids(p["ids"])],
+)
+async def get_lines(ids: str):
+    """
+    This endpoint returns many lines at once. `ids` is a comma separated list
+    of up to 100 line ids. It returns:
+    * `results`: the lines found, in the order requested, each as returned by
+      `/lines/{line_id}`.
+    * `missing`: the requested ids that match no line.
+    """
+    line_ids = multiget.parse_ids(ids)
+    stmt = sqlalchemy.select(
+        db.lines.c.line_id,
+        db.lines.c.character_id,
+        db.characters.c.name.label("character"),
+        db.lines.c.movie_id,
+        db.movies.c.title.label("movie"),
+        db.lines.c.line_text.label("text"),
+    ).select_from(
+        db.lines.join(
+            db.characters, db.lines.c.character_id == db.characters.c.character_id
+        ).join(
+            db.movies, db.lines.c.movie_id == db.movies.c.movie_id
+        )
+    ).where(multiget.any_of(db.lines.c.line_id, line_ids))
+
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
+    found = {line["line_id"]: line for line in encoding.records(result)}
+    return multiget.in_order(line_ids, found)
 
 
 
@@ -55,14 +90,50 @@ def get_line(line_id: int):
 class line_sort_options(str, Enum):
     movie_title = "movie_title"
     character = "character"
+    relevance = "relevance"
+
+
+async def search_in_process(response, stmt, text, movie_title, limit, offset, cursor):
+    "serves sort=relevance from the in-process index when the database can't"
+    async with db.engine.connect() as conn:
+        movie_ids = None
+        if movie_title != "":
+            movie_ids = set(
+                (
+                    await conn.execute(
+                        sqlalchemy.select(db.movies.c.movie_id).where(
+                            db.movies.c.title.like(f"%{movie_title}%")
+                        )
+                    )
+                ).scalars()
+            )
+
+        matches = (await search.get_index()).search(text, movie_ids)
+        if cursor:
+            rank, line_id = pagination.decode_cursor(cursor, ("rank", "line_id"))
+            matches = [match for match in matches if (-match[0], match[1]) > (-rank, line_id)]
+        page = matches[offset:offset + limit]
+
+        rows = (
+            await conn.execute(
+                stmt.where(db.lines.c.line_id.in_([line_id for _, line_id in page]))
+            )
+        ).fetchall()
+
+    by_id = {record["line_id"]: record for record in encoding.records(rows)}
+    if len(page) == limit:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = pagination.encode_cursor(list(page[-1]))
+    return encoding.JSONResponse([by_id[line_id] for _, line_id in page], headers=response.headers)
 
 
 @router.get("/lines/", tags=["lines"])
-def list_lines(text: str = "",
+async def list_lines(response: Response,
+    text: str = "",
     movie_title: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
-    sort: line_sort_options = line_sort_options.movie_title
+    sort: line_sort_options = line_sort_options.movie_title,
+    cursor: str = "",
 ):
     """
     This endpoint returns a list of lines. For each line it returns:
@@ -75,18 +146,18 @@ def list_lines(text: str = "",
     lines by the movie title with the `movie_title` query parameter.
 
     You can sort the lines by the movie title and character name by using the `sort` query parameter. 
+    With `sort=relevance` the `text` parameter becomes a word search instead of a
+    substring filter: lines containing every word are returned best match first.
 
     The `limit` and `offset` query
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
-    """
-    if sort == line_sort_options.movie_title:
-        sort_by = db.movies.c.title
-    elif sort == line_sort_options.character:
-        sort_by = db.characters.c.name
-
 
+    For deep paging pass the `X-Next-Cursor` response header of the previous page
+    as the `cursor` query parameter instead of increasing `offset`. The header is
+    omitted on the last page.
+    """
     stmt = sqlalchemy.select(
         db.lines.c.line_id,
         db.characters.c.name.label("character"),
@@ -98,25 +169,45 @@ def list_lines(text: str = "",
         ).join(
             db.movies, db.lines.c.movie_id == db.movies.c.movie_id
         )
-    ).where(
-        db.lines.c.line_text.like(f"%{text}%")
-    ).where(
-        db.movies.c.title.like(f"%{movie_title}%")
-    ).order_by(
-        sort_by
-    ).limit(limit).offset(offset)
-
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        json = []
-        for row in result:
-            json.append({
-                "line_id": row.line_id,
-                "character": row.character,
-                "movie": row.movie,
-                "text": row.text
-            })
-        return json
+    )
+
+    # empty filters are left out entirely so the default listing can walk an
+    # index in sort order
+    if movie_title != "":
+        stmt = stmt.where(db.movies.c.title.like(f"%{movie_title}%"))
+
+    if sort == line_sort_options.relevance:
+        if text == "":
+            raise HTTPException(status_code=400, detail="Relevance sort requires text")
+        if not search.uses_database_search():
+            return await search_in_process(response, stmt, text, movie_title, limit, offset, cursor)
+        rank = search.ts_rank(text)
+        keys = [(rank, True, "rank")]
+        stmt = stmt.add_columns(rank.label("rank")).where(search.ts_match(text))
+    else:
+        if sort == line_sort_options.movie_title:
+            keys = [(db.movies.c.title, False, "movie")]
+        elif sort == line_sort_options.character:
+            keys = [(db.characters.c.name, False, "character")]
+        if text != "":
+            stmt = stmt.where(db.lines.c.line_text.like(f"%{text}%"))
+    keys.append((db.lines.c.line_id, False, "line_id"))
+
+    stmt = pagination.paginate(stmt, keys, cursor, limit, offset)
+
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
+
+    next_cursor = pagination.next_cursor(result, keys, limit)
+    if next_cursor is not None:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    # the columns are labelled with the response field names; only the rank
+    # used for the relevance cursor is left out
+    body = encoding.records(result)
+    if sort == line_sort_options.relevance:
+        for record in body:
+            del record["rank"]
+    return encoding.JSONResponse(body, headers=response.headers)
 
 
     
@@ -1,25 +1,22 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from enum import Enum
 
 import sqlalchemy
 from src import database as db
+from src import cache
+from src import encoding
+from src import graph
+from src import multiget
+from src import pagination
+from src import stats
 from fastapi.params import Query
 
 router = APIRouter()
 
-def get_num_lines(character_id:int):
-    "returns the number of lines a character has"
-    stmt = sqlalchemy.select(
-        sqlalchemy.func.count(db.lines.c.line_id)
-    ).where(
-        db.lines.c.character_id == character_id
-    )
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        return result.scalar()
-    
+
 @router.get("/movies/{movie_id}", tags=["movies"])
-def get_movie(movie_id: int):
+@cache.cached("get_movie", ttl=300, tags=lambda p: [("movie", p["movie_id"])])
+async def get_movie(movie_id: int):
     """
     This endpoint returns a single movie by its identifier. For each movie it returns:
     * `movie_id`: the internal id of the movie.
@@ -35,40 +32,266 @@ def get_movie(movie_id: int):
 
     
     """
-    stmt = sqlalchemy.select(
-        db.movies.c.movie_id,
-        db.movies.c.title,
-        db.characters.c.character_id,
-        db.characters.c.name,
-    ).select_from(
-        db.movies.join(
-            db.characters, db.movies.c.movie_id == db.characters.c.movie_id
+    # line counts come from the maintained character_stats table, so ranking
+    # the cast is an index lookup and a single round trip
+    stmt = (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            db.characters.c.character_id,
+            db.characters.c.name,
+            db.character_stats.c.num_lines,
+        )
+        .select_from(
+            db.movies.join(
+                db.character_stats, db.movies.c.movie_id == db.character_stats.c.movie_id
+            ).join(
+                db.characters,
+                db.character_stats.c.character_id == db.characters.c.character_id,
+            )
+        )
+        .where(db.movies.c.movie_id == movie_id)
+        .order_by(
+            sqlalchemy.desc(db.character_stats.c.num_lines),
+            db.characters.c.character_id,
         )
-    ).where(db.movies.c.movie_id == movie_id)
+        .limit(5)
+    )
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        if result.rowcount == 0:
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
+        if len(result) == 0:
             raise HTTPException(status_code=404, detail="Movie not found")
-        json = {}
-        for row in result:
-            json["movie_id"] = row.movie_id
-            json["title"] = row.title
-            json.setdefault("top_characters", [])
-            json["top_characters"].append(
+        json = {
+            "movie_id": result[0].movie_id,
+            "title": result[0].title,
+            "top_characters": [
                 {
                     "character_id": row.character_id,
                     "character": row.name,
-                    "num_lines": get_num_lines(row.character_id),
+                    "num_lines": row.num_lines,
                 }
-            )
-        json["top_characters"] = sorted(
-            json["top_characters"], key=lambda x: x["num_lines"], reverse=True
-        )[:5]
+                for row in result
+            ],
+        }
         return json
-  
 
 
+@router.get("/movies:batch", tags=["movies"])
+@cache.cached(
+    "get_movies", ttl=300, tags=lambda p: [("movie", id) for id in multiget.parse_ids(p["ids"])]
+)
+async def get_movies(ids: str):
+    """
+    This endpoint returns many movies at once. `ids` is a comma separated list
+    of up to 100 movie ids. It returns:
+    * `results`: the movies found, in the order requested, each as returned by
+      `/movies/{movie_id}`.
+    * `missing`: the requested ids that match no movie.
+    """
+    movie_ids = multiget.parse_ids(ids)
+    # every movie's cast is ranked in the same statement, keeping the top five
+    ranked = (
+        sqlalchemy.select(
+            db.character_stats.c.movie_id,
+            db.characters.c.character_id,
+            db.characters.c.name,
+            db.character_stats.c.num_lines,
+            sqlalchemy.func.row_number()
+            .over(
+                partition_by=db.character_stats.c.movie_id,
+                order_by=(
+                    sqlalchemy.desc(db.character_stats.c.num_lines),
+                    db.characters.c.character_id,
+                ),
+            )
+            .label("rank"),
+        )
+        .select_from(
+            db.character_stats.join(
+                db.characters,
+                db.character_stats.c.character_id == db.characters.c.character_id,
+            )
+        )
+        .where(multiget.any_of(db.character_stats.c.movie_id, movie_ids))
+        .subquery()
+    )
+    stmt = (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            ranked.c.character_id,
+            ranked.c.name,
+            ranked.c.num_lines,
+        )
+        .select_from(
+            db.movies.outerjoin(
+                ranked,
+                sqlalchemy.and_(ranked.c.movie_id == db.movies.c.movie_id, ranked.c.rank <= 5),
+            )
+        )
+        .where(multiget.any_of(db.movies.c.movie_id, movie_ids))
+        .order_by(db.movies.c.movie_id, ranked.c.rank)
+    )
+
+    async with db.engine.connect() as conn:
+        result = await conn.execute(stmt)
+        found = {}
+        for row in result:
+            if row.movie_id not in found:
+                found[row.movie_id] = {
+                    "movie_id": row.movie_id,
+                    "title": row.title,
+                    "top_characters": [],
+                }
+            if row.character_id is not None:
+                found[row.movie_id]["top_characters"].append(
+                    {
+                        "character_id": row.character_id,
+                        "character": row.name,
+                        "num_lines": row.num_lines,
+                    }
+                )
+
+    return multiget.in_order(movie_ids, found)
+
+
+@router.get("/movies/{movie_id}/graph", tags=["movies"])
+@cache.cached("get_movie_graph", ttl=300, tags=lambda p: [("movie", p["movie_id"])])
+async def get_movie_graph(movie_id: int):
+    """
+    This endpoint returns who talks to whom in a movie. It returns:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `characters`: The characters in the movie, each with its `character_id`
+      and `character` name.
+    * `edges`: The pairs of characters that talk to each other, each with
+      `character_1_id`, `character_2_id`, `number_of_lines_together` and
+      `number_of_conversations`.
+    """
+    stmt = (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            db.characters.c.character_id,
+            db.characters.c.name,
+        )
+        .select_from(
+            db.movies.outerjoin(db.characters, db.characters.c.movie_id == db.movies.c.movie_id)
+        )
+        .where(db.movies.c.movie_id == movie_id)
+        .order_by(db.characters.c.character_id)
+    )
+
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
+    if len(result) == 0:
+        raise HTTPException(status_code=404, detail="Movie not found")
+
+    interactions = await graph.get_graph()
+    cast = [row for row in result if row.character_id is not None]
+    cast_ids = {row.character_id for row in cast}
+    edges = []
+    for row in cast:
+        for partner_id, (lines, conversations) in sorted(
+            interactions.neighbors(row.character_id).items()
+        ):
+            if row.character_id < partner_id and partner_id in cast_ids:
+                edges.append(
+                    {
+                        "character_1_id": row.character_id,
+                        "character_2_id": partner_id,
+                        "number_of_lines_together": lines,
+                        "number_of_conversations": conversations,
+                    }
+                )
+
+    return {
+        "movie_id": result[0].movie_id,
+        "title": result[0].title,
+        "characters": [
+            {"character_id": row.character_id, "character": row.name} for row in cast
+        ],
+        "edges": edges,
+    }
+
+
+@router.get("/movies/{movie_id}/stats", tags=["movies"])
+@cache.cached("get_movie_stats", ttl=300, tags=lambda p: [("movie", p["movie_id"])])
+async def get_movie_stats(movie_id: int):
+    """
+    This endpoint returns dialogue statistics for a single movie:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `num_lines`: The number of lines in the movie.
+    * `num_conversations`: The number of conversations in the movie.
+    * `num_characters`: The number of characters in the movie.
+    * `average_line_length`: The average length of a line, in characters.
+    * `lines_by_gender`: For each character gender (null when unknown), the
+      `num_characters` of that gender and their `num_lines`.
+    * `conversation_lengths`: The number of conversations with each number of
+      lines, keyed by the number of lines.
+    * `lines_per_character`: Every character in the movie with its
+      `character_id`, `character` name, `gender` and `num_lines`, most lines
+      first.
+
+    The statistics are aggregated in the database and cached.
+    """
+    async with db.engine.connect() as conn:
+        analytics = await conn.run_sync(stats.movie_analytics, movie_id)
+        if movie_id not in analytics:
+            raise HTTPException(status_code=404, detail="Movie not found")
+        result = (
+            await conn.execute(
+                sqlalchemy.select(
+                    db.characters.c.character_id,
+                    db.characters.c.name.label("character"),
+                    db.characters.c.gender,
+                    db.character_stats.c.num_lines,
+                )
+                .select_from(
+                    db.characters.join(
+                        db.character_stats,
+                        db.character_stats.c.character_id == db.characters.c.character_id,
+                    )
+                )
+                .where(db.characters.c.movie_id == movie_id)
+                .order_by(
+                    sqlalchemy.desc(db.character_stats.c.num_lines),
+                    db.characters.c.character_id,
+                )
+            )
+        ).fetchall()
+
+    json = analytics[movie_id]
+    json["lines_per_character"] = encoding.records(result)
+    return json
+
+
+@router.get("/stats/movies", tags=["movies"])
+@cache.cached("list_movie_stats", ttl=300, tags=lambda p: [("movies",)])
+async def list_movie_stats():
+    """
+    This endpoint returns dialogue statistics for every movie at once, ordered
+    by `movie_id`. For each movie it returns:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `num_lines`: The number of lines in the movie.
+    * `num_conversations`: The number of conversations in the movie.
+    * `num_characters`: The number of characters in the movie.
+    * `average_line_length`: The average length of a line, in characters.
+    * `lines_by_gender`: For each character gender (null when unknown), the
+      `num_characters` of that gender and their `num_lines`.
+    * `conversation_lengths`: The number of conversations with each number of
+      lines, keyed by the number of lines.
+
+    Each statistic is one grouped aggregate over all movies, and the result is
+    cached, so a dashboard of every movie costs a single request.
+    """
+    async with db.engine.connect() as conn:
+        analytics = await conn.run_sync(stats.movie_analytics)
+    return list(analytics.values())
+
 
 class movie_sort_options(str, Enum):
     movie_title = "movie_title"
@@ -78,11 +301,14 @@ class movie_sort_options(str, Enum):
 
 # Add get parameters
 @router.get("/movies/", tags=["movies"])
-def list_movies(
+@cache.cached("list_movies", ttl=300)
+async def list_movies(
+    response: Response,
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: movie_sort_options = movie_sort_options.movie_title,
+    cursor: str = "",
 ):
     """
     This endpoint returns a list of movies. For each movie it returns:
@@ -105,45 +331,44 @@ def list_movies(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    For deep paging pass the `X-Next-Cursor` response header of the previous page
+    as the `cursor` query parameter instead of increasing `offset`. The header is
+    omitted on the last page.
     """
     if sort is movie_sort_options.movie_title:
-        order_by = db.movies.c.title
+        keys = [(db.movies.c.title, False, "movie_title")]
     elif sort is movie_sort_options.year:
-        order_by = db.movies.c.year
+        keys = [(db.movies.c.year, False, "year")]
     elif sort is movie_sort_options.rating:
-        order_by = sqlalchemy.desc(db.movies.c.imdb_rating)
+        keys = [(db.movies.c.imdb_rating, True, "imdb_rating")]
     else:
         assert False
+    keys.append((db.movies.c.movie_id, False, "movie_id"))
 
-    stmt = (
+    stmt = pagination.paginate(
         sqlalchemy.select(
             db.movies.c.movie_id,
-            db.movies.c.title,
+            db.movies.c.title.label("movie_title"),
             db.movies.c.year,
             db.movies.c.imdb_rating,
             db.movies.c.imdb_votes,
-        )
-        .limit(limit)
-        .offset(offset)
-        .order_by(order_by, db.movies.c.movie_id)
+        ),
+        keys,
+        cursor,
+        limit,
+        offset,
     )
 
     # filter only if name parameter is passed
     if name != "":
         stmt = stmt.where(db.movies.c.title.ilike(f"%{name}%"))
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        json = []
-        for row in result:
-            json.append(
-                {
-                    "movie_id": row.movie_id,
-                    "movie_title": row.title,
-                    "year": row.year,
-                    "imdb_rating": row.imdb_rating,
-                    "imdb_votes": row.imdb_votes,
-                }
-            )
+    async with db.engine.connect() as conn:
+        result = (await conn.execute(stmt)).fetchall()
 
-    return json
+    next_cursor = pagination.next_cursor(result, keys, limit)
+    if next_cursor is not None:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    # the columns are labelled with the response field names
+    return encoding.records(result)
@@ -1,6 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
+from src import cache
+from src import database as db
+from src import instrumentation, metrics
 import os
-import pkg_resources
 import sys
 
 router = APIRouter()
@@ -24,6 +26,9 @@ def version():
 
 @router.get("/pkgsize/")
 def get_pkgsize():
+    # pkg_resources takes a noticeable share of cold start time to import
+    import pkg_resources
+
     dists = [d for d in pkg_resources.working_set]
 
     message = []
@@ -44,3 +49,86 @@ def get_pkgsize():
 
     message = sorted(message, key=lambda d: d["size_in_mb"], reverse=True)
     return {"message": message}
+
+
+@router.get("/debug/pool")
+def pool_status():
+    return db.pool_status()
+
+
+@router.get("/debug/cache")
+def cache_status():
+    return cache.responses.stats()
+
+
+@router.get("/debug/queries")
+def query_stats():
+    "percentiles of duration, database time, statements and rows per route"
+    return instrumentation.route_stats()
+
+
+@router.get("/metrics", response_class=Response)
+def prometheus_metrics():
+    "request, pool, cache and process metrics in the Prometheus text format"
+    page = metrics.Exposition()
+    page.histogram(
+        "http_request_duration_seconds",
+        "Time to serve HTTP requests.",
+        instrumentation.request_duration.items(),
+    )
+    page.metric(
+        "gauge",
+        "http_requests_in_flight",
+        "HTTP requests being served.",
+        [({}, instrumentation.requests_in_flight.value())],
+    )
+
+    pool = db.pool_status()
+    for name, help in (
+        ("checked_out", "Connections in use."),
+        ("idle", "Connections idle in the pool."),
+        ("overflow", "Connections open beyond the pool size."),
+        ("size", "Connections the pool keeps open."),
+    ):
+        if name in pool:
+            page.metric("gauge", f"db_pool_{name}", help, [({}, pool[name])])
+    page.histogram(
+        "db_pool_wait_seconds", "Time spent waiting for a connection.", [({}, db.pool_wait)]
+    )
+
+    responses = cache.responses.stats()
+    routes = responses["routes"].items()
+    page.metric(
+        "counter",
+        "response_cache_hits_total",
+        "Responses served from the cache.",
+        [({"route": route}, counts["hits"]) for route, counts in routes],
+    )
+    page.metric(
+        "counter",
+        "response_cache_misses_total",
+        "Responses computed because they were not cached.",
+        [({"route": route}, counts["misses"]) for route, counts in routes],
+    )
+    page.metric(
+        "gauge",
+        "response_cache_hit_ratio",
+        "Share of lookups served from the cache.",
+        [
+            ({"route": route}, round(counts["hits"] / (counts["hits"] + counts["misses"]), 4))
+            for route, counts in routes
+            if counts["hits"] + counts["misses"]
+        ],
+    )
+    page.metric("gauge", "response_cache_entries", "Responses in the cache.", [({}, responses["entries"])])
+    page.metric(
+        "counter",
+        "response_cache_evictions_total",
+        "Responses evicted to make room.",
+        [({}, responses["evictions"])],
+    )
+
+    rss = metrics.resident_memory()
+    if rss is not None:
+        page.metric("gauge", "process_resident_memory_bytes", "Resident memory size.", [({}, rss)])
+    return Response(page.text(), media_type=metrics.Exposition.CONTENT_TYPE)
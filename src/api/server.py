@@ -1,5 +1,7 @@
 from fastapi import FastAPI
-from src.api import characters, movies, lines, conversations, pkg_util
+from src.api import characters, movies, lines, conversations, export, pkg_util
+from src import database as db
+from src import encoding, instrumentation
 
 description = """
 Movie API returns dialog statistics on top hollywood movies from decades past.
@@ -28,7 +30,11 @@ tags_metadata = [
     {
         "name": "lines",
         "description": "Access information on movie lines.",
-    }
+    },
+    {
+        "name": "export",
+        "description": "Download whole tables as NDJSON or CSV.",
+    },
 ]
 
 app = FastAPI(
@@ -40,12 +46,27 @@ app = FastAPI(
         "email": "arosen12@calpoly.edu",
     },
     openapi_tags=tags_metadata,
+    default_response_class=encoding.JSONResponse,
 )
+app.add_middleware(instrumentation.QueryStatsMiddleware)
 app.include_router(characters.router)
 app.include_router(movies.router)
 app.include_router(lines.router)
 app.include_router(pkg_util.router)
 app.include_router(conversations.router)
+app.include_router(export.router)
+
+
+@app.on_event("startup")
+async def startup():
+    # the memory backend loads the CSVs when its engine is first used, which
+    # is better done before serving than by the first request
+    db.lazy("engine")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await db.dispose()
 
 
 @app.get("/")
@@ -0,0 +1,221 @@
+import enum
+import functools
+import hashlib
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, Response
+
+from src import encoding
+
+# In-process cache for the read endpoints.
+#
+# Entries are keyed on the route plus its normalized parameters, expire after
+# a per route TTL and are evicted least recently used first once the cache is
+# full. Each entry also carries tags such as ("movie", 44) naming the data it
+# was built from, so add_conversation can drop exactly the entries a new
+# conversation makes stale. The TTLs bound staleness from writes made by other
+# instances. RESPONSE_CACHE_SIZE=0 turns the cache off.
+#
+# Responses are validated for HTTP revalidation by what they contain: the
+# ETag is a hash of the body, so every instance gives the same response the
+# same ETag and a change made anywhere changes it, and Last-Modified is when
+# the body was built. A request whose If-None-Match or If-Modified-Since
+# still matches the response it would get, cached or freshly built, gets a
+# 304 without the body; an id that no longer exists still gets its 404.
+# Cache-Control lets browsers revalidate every time while a CDN keeps a
+# response for the route's TTL.
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.tagged = {}
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        self.generations = {}
+
+    def get(self, key):
+        "returns the live entry for key, or None"
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses[key[0]] = self.misses.get(key[0], 0) + 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+            return entry
+
+    def put(self, key, ttl: float, value, headers, tags=()):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + ttl, value, headers, tuple(tags))
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        "drops every entry carrying any of tags and moves the tags to a new generation"
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                self.generations[tag] = self.generation
+                for key in list(self.tagged.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def version(self, tags):
+        "returns the generation of data carrying tags, which invalidate moves on"
+        with self.lock:
+            return max((self.generations.get(tag, 0) for tag in tags), default=0)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tagged.clear()
+
+    def stats(self):
+        "returns the entry count and the hit and miss counters per route"
+        with self.lock:
+            routes = sorted(set(self.hits) | set(self.misses))
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "routes": {
+                    route: {
+                        "hits": self.hits.get(route, 0),
+                        "misses": self.misses.get(route, 0),
+                    }
+                    for route in routes
+                },
+            }
+
+    def _remove(self, key):
+        _, _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+
+responses = ResponseCache(int(os.environ.get("RESPONSE_CACHE_SIZE", "1024")))
+
+
+def normalize(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+
+def etag(body: bytes):
+    "returns the ETag of a response body"
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def not_modified(request: Request, headers):
+    "returns whether the client's copy, per its conditional headers, is the response's"
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # weak comparison, as for GET
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return headers["ETag"].removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return parsedate_to_datetime(headers["Last-Modified"]).timestamp() <= since
+    return False
+
+
+def cached(route: str, ttl: int, tags=None):
+    """
+    caches the encoded JSON of what an endpoint returns, along with any
+    headers it set on its Response parameter, and answers conditional
+    requests for it. tags maps
+    the endpoint parameters to the tags of the entry. Errors raised by the
+    endpoint are not cached.
+    """
+
+    def decorate(endpoint):
+        signature = inspect.signature(endpoint)
+        # FastAPI hands its Response to a single parameter, the one added below
+        response_params = [
+            name for name, param in signature.parameters.items() if param.annotation is Response
+        ]
+
+        @functools.wraps(endpoint)
+        async def wrapper(cache_request: Request, cache_response: Response, **kwargs):
+            for name in response_params:
+                kwargs[name] = cache_response
+            params = tuple(
+                sorted(
+                    (name, normalize(value))
+                    for name, value in kwargs.items()
+                    if not isinstance(value, Response)
+                )
+            )
+            key = (route, params)
+            entry_tags = tuple(tags(dict(params))) if tags else ()
+
+            entry = responses.get(key)
+            if entry is not None:
+                _, body, headers, _ = entry
+            else:
+                generation = responses.version(entry_tags)
+                value = await endpoint(**kwargs)
+                body = encoding.dumps(value)
+                headers = {
+                    **cache_response.headers,
+                    "ETag": etag(body),
+                    "Last-Modified": formatdate(time.time(), usegmt=True),
+                    "Cache-Control": f"public, max-age=0, s-maxage={ttl}",
+                }
+                # a write that landed while the query ran may have made the
+                # value stale already
+                if responses.version(entry_tags) == generation:
+                    responses.put(key, ttl, body, headers, entry_tags)
+
+            if not_modified(cache_request, headers):
+                validators = ("ETag", "Last-Modified", "Cache-Control")
+                return Response(status_code=304, headers={name: headers[name] for name in validators})
+            return Response(body, media_type="application/json", headers=headers)
+
+        # FastAPI reads the parameters to inject from the signature
+        wrapper.__signature__ = signature.replace(
+            parameters=[
+                *signature.parameters.values(),
+                inspect.Parameter(
+                    "cache_request", inspect.Parameter.KEYWORD_ONLY, annotation=Request
+                ),
+                inspect.Parameter(
+                    "cache_response", inspect.Parameter.KEYWORD_ONLY, annotation=Response
+                ),
+            ]
+        )
+        return wrapper
+
+    return decorate
@@ -1,25 +1,35 @@
+import asyncio
+import contextlib
+import contextvars
 import csv
 from src.datatypes import Character, Movie, Conversation, Line
+from src import instrumentation, metrics
 import os
 import io
-from supabase import Client, create_client
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter
 import dotenv
-from sqlalchemy import create_engine
 import sqlalchemy
+from sqlalchemy.ext.asyncio import create_async_engine
 
 # # DO NOT CHANGE THIS TO BE HARDCODED. ONLY PULL FROM ENVIRONMENT VARIABLES.
 dotenv.load_dotenv()
-supabase_api_key = os.environ.get("SUPABASE_API_KEY")
-supabase_url = os.environ.get("SUPABASE_URL")
 
-if supabase_api_key is None or supabase_url is None:
-    raise Exception(
-        "You must set the SUPABASE_API_KEY and SUPABASE_URL environment variables."
-    )
+# "postgres" serves the API from the Supabase database. "memory" loads the
+# bundled CSVs into an in-process SQLite database instead, for read-only
+# replicas and offline test runs. Its data directory must also hold a
+# lines.csv, which isn't bundled; test.corpus generates one.
+backend = os.environ.get("MOVIE_API_BACKEND", "postgres")
+data_dir = os.environ.get(
+    "MOVIE_API_DATA_DIR", os.path.join(os.path.dirname(__file__), "..")
+)
 
-supabase: Client = create_client(supabase_url, supabase_api_key)
+if backend not in ("postgres", "memory"):
+    raise Exception("MOVIE_API_BACKEND must be either postgres or memory.")
 
-sess = supabase.auth.get_session()
 
 def database_connection_url():
     dotenv.load_dotenv()
@@ -28,15 +38,523 @@ def database_connection_url():
     DB_SERVER: str = os.environ.get("POSTGRES_SERVER")
     DB_PORT: str = os.environ.get("POSTGRES_PORT")
     DB_NAME: str = os.environ.get("POSTGRES_DB")
-    return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
-
-engine = sqlalchemy.create_engine(database_connection_url())
+    return f"postgresql+asyncpg://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
 
-conn = engine.connect()
 
+# indexes are created by the versioned migrations in src.migrations
 metadata_obj = sqlalchemy.MetaData()
 
-conversations = sqlalchemy.Table("conversations", metadata_obj, autoload_with=engine)
-lines = sqlalchemy.Table("lines", metadata_obj, autoload_with=engine)
-movies = sqlalchemy.Table("movies", metadata_obj, autoload_with=engine)
-characters = sqlalchemy.Table("characters", metadata_obj, autoload_with=engine)
+movies = sqlalchemy.Table(
+    "movies",
+    metadata_obj,
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("title", sqlalchemy.Text),
+    sqlalchemy.Column("year", sqlalchemy.Text),
+    sqlalchemy.Column("imdb_rating", sqlalchemy.Float),
+    sqlalchemy.Column("imdb_votes", sqlalchemy.Integer),
+    sqlalchemy.Column("raw_script_url", sqlalchemy.Text),
+)
+characters = sqlalchemy.Table(
+    "characters",
+    metadata_obj,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.Text),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer),
+    sqlalchemy.Column("gender", sqlalchemy.Text),
+    sqlalchemy.Column("age", sqlalchemy.Integer),
+)
+conversations = sqlalchemy.Table(
+    "conversations",
+    metadata_obj,
+    sqlalchemy.Column("conversation_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("character1_id", sqlalchemy.Integer),
+    sqlalchemy.Column("character2_id", sqlalchemy.Integer),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer),
+)
+lines = sqlalchemy.Table(
+    "lines",
+    metadata_obj,
+    sqlalchemy.Column("line_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("character_id", sqlalchemy.Integer),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer),
+    sqlalchemy.Column("conversation_id", sqlalchemy.Integer),
+    sqlalchemy.Column("line_sort", sqlalchemy.Integer),
+    sqlalchemy.Column("line_text", sqlalchemy.Text),
+)
+
+# line counts maintained by src.stats so the read endpoints never have to
+# aggregate the whole lines table
+character_stats = sqlalchemy.Table(
+    "character_stats",
+    metadata_obj,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("num_lines", sqlalchemy.Integer, nullable=False),
+)
+movie_stats = sqlalchemy.Table(
+    "movie_stats",
+    metadata_obj,
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("num_lines", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("num_conversations", sqlalchemy.Integer, nullable=False),
+)
+
+
+def try_parse(type, val):
+    try:
+        return type(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_csv(name):
+    "returns the rows of a csv file in the data directory"
+    if not os.path.isdir(data_dir):
+        raise Exception(f"MOVIE_API_DATA_DIR {data_dir} is not a directory.")
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        raise Exception(f"{name} is missing from the data directory {data_dir}.")
+    with open(path, mode="r", encoding="utf8") as csv_file:
+        return list(csv.DictReader(csv_file, skipinitialspace=True))
+
+
+def insert_rows(conn, table, rows):
+    """
+    inserts a list of row dicts that all have the same keys. They go to the
+    driver as tuples, since building SQLAlchemy's parameters row by row took
+    most of the corpus load. An empty list is skipped: executing an insert
+    without parameters would add one row of defaults.
+    """
+    if not rows:
+        return
+    stmt = sqlalchemy.insert(table).compile(
+        dialect=conn.dialect, column_keys=list(rows[0])
+    )
+    conn.exec_driver_sql(
+        str(stmt), [tuple(row[key] for key in stmt.positiontup) for row in rows]
+    )
+
+
+def load_csv_corpus(conn):
+    """
+    fills the tables from movies.csv, characters.csv, conversations.csv and
+    lines.csv. The line counts are tallied while loading so the
+    statistics tables are ready without an aggregate pass.
+    """
+    corpus_movies = [
+        Movie(
+            try_parse(int, row["movie_id"]),
+            row["title"] or None,
+            row["year"] or None,
+            try_parse(float, row["imdb_rating"]),
+            try_parse(int, row["imdb_votes"]),
+            row["raw_script_url"] or None,
+        )
+        for row in read_csv("movies.csv")
+    ]
+    corpus_lines = [
+        Line(
+            try_parse(int, row["line_id"]),
+            try_parse(int, row["character_id"]),
+            try_parse(int, row["movie_id"]),
+            try_parse(int, row["conversation_id"]),
+            try_parse(int, row["line_sort"]),
+            row["line_text"],
+        )
+        for row in read_csv("lines.csv")
+    ]
+    character_lines = Counter(line.c_id for line in corpus_lines)
+    conversation_lines = Counter(line.conv_id for line in corpus_lines)
+    corpus_characters = [
+        Character(
+            try_parse(int, row["character_id"]),
+            row["name"] or None,
+            try_parse(int, row["movie_id"]),
+            row["gender"] or None,
+            try_parse(int, row["age"]),
+            character_lines[try_parse(int, row["character_id"])],
+        )
+        for row in read_csv("characters.csv")
+    ]
+    corpus_conversations = [
+        Conversation(
+            try_parse(int, row["conversation_id"]),
+            try_parse(int, row["character1_id"]),
+            try_parse(int, row["character2_id"]),
+            try_parse(int, row["movie_id"]),
+            conversation_lines[try_parse(int, row["conversation_id"])],
+        )
+        for row in read_csv("conversations.csv")
+    ]
+
+    insert_rows(
+        conn,
+        movies,
+        [
+            {
+                "movie_id": movie.id,
+                "title": movie.title,
+                "year": movie.year,
+                "imdb_rating": movie.imdb_rating,
+                "imdb_votes": movie.imdb_votes,
+                "raw_script_url": movie.raw_script_url,
+            }
+            for movie in corpus_movies
+        ],
+    )
+    insert_rows(
+        conn,
+        characters,
+        [
+            {
+                "character_id": character.id,
+                "name": character.name,
+                "movie_id": character.movie_id,
+                "gender": character.gender,
+                "age": character.age,
+            }
+            for character in corpus_characters
+        ],
+    )
+    insert_rows(
+        conn,
+        conversations,
+        [
+            {
+                "conversation_id": conversation.id,
+                "character1_id": conversation.c1_id,
+                "character2_id": conversation.c2_id,
+                "movie_id": conversation.movie_id,
+            }
+            for conversation in corpus_conversations
+        ],
+    )
+    insert_rows(
+        conn,
+        lines,
+        [
+            {
+                "line_id": line.id,
+                "character_id": line.c_id,
+                "movie_id": line.movie_id,
+                "conversation_id": line.conv_id,
+                "line_sort": line.line_sort,
+                "line_text": line.line_text,
+            }
+            for line in corpus_lines
+        ],
+    )
+
+    insert_rows(
+        conn,
+        character_stats,
+        [
+            {
+                "character_id": character.id,
+                "movie_id": character.movie_id,
+                "num_lines": character.num_lines,
+            }
+            for character in corpus_characters
+        ],
+    )
+    movie_lines = Counter(line.movie_id for line in corpus_lines)
+    movie_conversations = Counter(
+        conversation.movie_id for conversation in corpus_conversations
+    )
+    insert_rows(
+        conn,
+        movie_stats,
+        [
+            {
+                "movie_id": movie.id,
+                "num_lines": movie_lines[movie.id],
+                "num_conversations": movie_conversations[movie.id],
+            }
+            for movie in corpus_movies
+        ],
+    )
+
+
+def env_flag(name, default: bool):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def env_number(name, type, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        kind = "an integer" if type is int else "a number"
+        raise Exception(f"{name} must be {kind}, not {value!r}.")
+
+
+class TimedPoolMixin:
+    "records how long every checkout waited for a connection in pool_wait"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - start)
+
+
+class TimedQueuePool(TimedPoolMixin, sqlalchemy.pool.AsyncAdaptedQueuePool):
+    pass
+
+
+class TimedNullPool(TimedPoolMixin, sqlalchemy.pool.NullPool):
+    pass
+
+
+pool_wait = metrics.Histogram()
+pool_checked_out = metrics.Gauge()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_checked_out.inc()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    pool_checked_out.dec()
+
+
+def pool_mode():
+    """
+    "queue" keeps a pool of connections per process. "null" opens a
+    connection per checkout and closes it afterwards, which suits serverless
+    deployments (Vercel sets VERCEL) where pooled connections would outlive
+    the function, and deployments behind pgbouncer or the Supabase pooler.
+    """
+    default = "null" if os.environ.get("VERCEL") else "queue"
+    mode = os.environ.get("DB_POOL_MODE", default)
+    if mode not in ("queue", "null"):
+        raise Exception("DB_POOL_MODE must be either queue or null.")
+    return mode
+
+
+def pool_options():
+    "returns the create_engine pool arguments from the DB_POOL_* environment variables"
+    options = {"pool_pre_ping": env_flag("DB_POOL_PRE_PING", True)}
+    if env_flag("DB_PGBOUNCER", False):
+        # pgbouncer in transaction mode can't keep asyncpg's prepared statements
+        options["connect_args"] = {"statement_cache_size": 0}
+        options["prepared_statement_cache_size"] = 0
+    if pool_mode() == "null":
+        options["poolclass"] = TimedNullPool
+    else:
+        options["poolclass"] = TimedQueuePool
+        options["pool_size"] = env_number("DB_POOL_SIZE", int, 5)
+        options["max_overflow"] = env_number("DB_MAX_OVERFLOW", int, 10)
+        options["pool_timeout"] = env_number("DB_POOL_TIMEOUT", float, 30.0)
+        options["pool_recycle"] = env_number("DB_POOL_RECYCLE", int, 1800)
+    return options
+
+
+def pool_status():
+    "returns the current state of the engine's connection pool"
+    pool = lazy("engine").pool
+    status = {
+        "mode": "static" if backend == "memory" else pool_mode(),
+        "checked_out": pool_checked_out.value(),
+        "idle": 0,
+        "overflow": 0,
+        "wait_seconds": pool_wait.snapshot(),
+    }
+    if isinstance(pool, sqlalchemy.pool.QueuePool):
+        status["size"] = pool.size()
+        status["idle"] = pool.checkedin()
+        status["overflow"] = max(pool.overflow(), 0)
+    return status
+
+
+def build_memory_loader():
+    """
+    loads the CSVs into a named shared-cache in-memory SQLite database and
+    returns the synchronous engine whose connection keeps it alive
+    """
+    uri = f"file:movie_api_{uuid.uuid4().hex}?mode=memory&cache=shared&uri=true"
+    loader = sqlalchemy.create_engine(
+        f"sqlite:///{uri}",
+        poolclass=sqlalchemy.pool.StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+    metadata_obj.create_all(loader)
+    with loader.begin() as conn:
+        load_csv_corpus(conn)
+    from src import migrations
+
+    with loader.connect() as conn:
+        migrations.apply(conn)
+    return loader
+
+
+class SerializedEngine:
+    """
+    the memory backend's engine. Every coroutine shares its one connection,
+    so one request's commit or rollback would end the transactions of the
+    others; instead connect() and begin() take turns on a lock, per event
+    loop. A task that already holds the lock, such as a request building the
+    search index inside its own connection, goes straight through.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._locks = weakref.WeakKeyDictionary()
+        self._holding = contextvars.ContextVar("holding_memory_engine", default=False)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    @contextlib.asynccontextmanager
+    async def _turn(self):
+        if self._holding.get():
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            lock = self._locks[loop] = asyncio.Lock()
+        async with lock:
+            token = self._holding.set(True)
+            try:
+                yield
+            finally:
+                self._holding.reset(token)
+
+    @contextlib.asynccontextmanager
+    async def connect(self):
+        async with self._turn(), self.engine.connect() as conn:
+            yield conn
+
+    @contextlib.asynccontextmanager
+    async def begin(self):
+        async with self._turn(), self.engine.begin() as conn:
+            yield conn
+
+
+def memory_engine(loader):
+    "returns a serialized async engine on the database a memory loader keeps alive"
+    engine = create_async_engine(
+        str(loader.url).replace("sqlite://", "sqlite+aiosqlite://", 1),
+        poolclass=sqlalchemy.pool.StaticPool,
+    )
+    instrumentation.instrument(engine)
+    return SerializedEngine(engine)
+
+
+def build_engine():
+    "returns a new async engine for the configured backend, ready to serve queries"
+    if backend == "memory":
+        return memory_engine(lazy("memory_loader"))
+    engine = create_async_engine(database_connection_url(), **pool_options())
+    sqlalchemy.event.listen(engine.sync_engine, "checkout", _on_checkout)
+    sqlalchemy.event.listen(engine.sync_engine, "checkin", _on_checkin)
+    instrumentation.instrument(engine)
+    return engine
+
+
+async def allocate_ids(conn, column, count: int):
+    """
+    reserves count new ids for a generated id column. On Postgres they come
+    from the column's sequence in one round trip; SQLite assigns the next
+    rowid after the current maximum, so the ids after it are taken instead.
+    """
+    if count == 0:
+        return []
+    if conn.dialect.name == "postgresql":
+        result = await conn.execute(
+            sqlalchemy.text(
+                "SELECT nextval(pg_get_serial_sequence(:table, :column)) "
+                "FROM generate_series(1, :count)"
+            ),
+            {"table": column.table.name, "column": column.name, "count": count},
+        )
+        return sorted(result.scalars())
+    next_id = sqlalchemy.func.coalesce(sqlalchemy.func.max(column), -1) + 1
+    first = (await conn.execute(sqlalchemy.select(next_id))).scalar_one()
+    return list(range(first, first + count))
+
+
+async def copy_rows(conn, table, rows):
+    """
+    bulk inserts a list of row dicts that all have the same keys. Postgres
+    gets a COPY through the asyncpg connection inside the current transaction,
+    other databases an executemany INSERT.
+    """
+    if not rows:
+        return
+    if conn.dialect.name != "postgresql":
+        await conn.execute(sqlalchemy.insert(table), rows)
+        return
+    columns = list(rows[0])
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        table.name,
+        records=[tuple(row[column] for column in columns) for row in rows],
+        columns=columns,
+    )
+
+
+def build_supabase_client():
+    # imported here because the supabase client is slow to import and is
+    # not needed to serve queries
+    from supabase import create_client
+
+    supabase_api_key = os.environ.get("SUPABASE_API_KEY")
+    supabase_url = os.environ.get("SUPABASE_URL")
+
+    if supabase_api_key is None or supabase_url is None:
+        raise Exception(
+            "You must set the SUPABASE_API_KEY and SUPABASE_URL environment variables."
+        )
+
+    return create_client(supabase_url, supabase_api_key)
+
+
+# The engine and the Supabase client are created on first use rather than at
+# import so a cold start can begin serving before any network round trip.
+# `db.engine` and `db.supabase` keep working through the module __getattr__.
+_lazy = {}
+_lazy_lock = threading.RLock()
+_factories = {
+    "engine": build_engine,
+    "memory_loader": build_memory_loader,
+    "supabase": build_supabase_client,
+}
+
+
+def lazy(name):
+    "returns the lazily created engine or supabase client, creating it if needed"
+    with _lazy_lock:
+        if name not in _lazy:
+            _lazy[name] = _factories[name]()
+        return _lazy[name]
+
+
+def override(name, value):
+    "makes lazy(name) return value, such as an engine set up by the tests"
+    with _lazy_lock:
+        _lazy[name] = value
+
+
+def __getattr__(name):
+    if name not in _factories:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return lazy(name)
+
+
+async def dispose():
+    "closes the engine's pooled connections, if an engine was ever created"
+    with _lazy_lock:
+        engine = _lazy.pop("engine", None)
+        loader = _lazy.pop("memory_loader", None)
+    if engine is not None:
+        await engine.dispose()
+    if loader is not None:
+        loader.dispose()
@@ -0,0 +1,43 @@
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.engine import Row, RowMapping
+
+# JSON encoding for responses.
+#
+# FastAPI runs whatever an endpoint returns through jsonable_encoder, which
+# walks and copies every value, before the response class encodes it. The
+# endpoints here label their columns with the response field names, turn the
+# rows into records in one pass and hand them to orjson directly by returning
+# a Response themselves.
+
+
+def records(rows):
+    """
+    returns rows as dicts keyed by column label. The labels are resolved once
+    for all rows, which is several times faster than going through each row's
+    _mapping.
+    """
+    if not rows:
+        return []
+    fields = [str(field) for field in rows[0]._fields]
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def default(value):
+    if isinstance(value, Row):
+        return records([value])[0]
+    if isinstance(value, RowMapping):
+        return {str(key): item for key, item in value.items()}
+    return jsonable_encoder(value)
+
+
+def dumps(value) -> bytes:
+    return orjson.dumps(value, default=default)
+
+
+class JSONResponse(ORJSONResponse):
+    "ORJSONResponse that also encodes SQLAlchemy rows as objects"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,163 @@
+import threading
+from array import array
+from collections import deque
+
+import sqlalchemy
+
+from src import database as db
+
+# Who talks to whom, as a weighted undirected graph over characters.
+#
+# The graph is built from conversations and lines on first use and stored in
+# CSR form: the edges of character c are entries offsets[c] to offsets[c + 1]
+# of the partners, lines and conversations arrays, so listing them costs
+# O(degree). Conversations added later go into a small overlay keyed by
+# character, which is folded into the arrays once it grows past a fraction of
+# the base graph.
+
+# fold the overlay back into the arrays when it holds this share of the edges
+COMPACT_RATIO = 0.1
+
+
+class InteractionGraph:
+    def __init__(self, edges):
+        """
+        edges maps (character_id, partner_id) pairs, one per direction, to
+        [lines together, conversations together]
+        """
+        self.overlay = {}
+        self.overlay_size = 0
+        self._build(edges)
+
+    def _build(self, edges):
+        ordered = sorted(edges.items())
+        size = max((a for (a, _), _ in ordered), default=-1) + 2
+        self.offsets = array("i", [0] * size)
+        self.partners = array("i")
+        self.lines = array("i")
+        self.conversations = array("i")
+        for (a, b), (lines, conversations) in ordered:
+            self.offsets[a + 1] += 1
+            self.partners.append(b)
+            self.lines.append(lines)
+            self.conversations.append(conversations)
+        for i in range(1, size):
+            self.offsets[i] += self.offsets[i - 1]
+
+    def _base(self, character_id: int):
+        if character_id < 0 or character_id + 1 >= len(self.offsets):
+            return range(0)
+        return range(self.offsets[character_id], self.offsets[character_id + 1])
+
+    def neighbors(self, character_id: int):
+        "returns {partner_id: (lines together, conversations together)}"
+        result = {
+            self.partners[i]: (self.lines[i], self.conversations[i])
+            for i in self._base(character_id)
+        }
+        for partner_id, (lines, conversations) in self.overlay.get(character_id, {}).items():
+            base_lines, base_conversations = result.get(partner_id, (0, 0))
+            result[partner_id] = (base_lines + lines, base_conversations + conversations)
+        return result
+
+    def add(self, character1_id: int, character2_id: int, lines: int, conversations: int = 1):
+        for a, b in ((character1_id, character2_id), (character2_id, character1_id)):
+            edge = self.overlay.setdefault(a, {}).setdefault(b, [0, 0])
+            if edge == [0, 0]:
+                self.overlay_size += 1
+            edge[0] += lines
+            edge[1] += conversations
+        if self.overlay_size > COMPACT_RATIO * max(len(self.partners), 1000):
+            self._compact()
+
+    def _compact(self):
+        edges = {}
+        for a in range(len(self.offsets) - 1):
+            for i in self._base(a):
+                edges[(a, self.partners[i])] = [self.lines[i], self.conversations[i]]
+        for a, partners in self.overlay.items():
+            for b, (lines, conversations) in partners.items():
+                edge = edges.setdefault((a, b), [0, 0])
+                edge[0] += lines
+                edge[1] += conversations
+        self.overlay = {}
+        self.overlay_size = 0
+        self._build(edges)
+
+    def network(self, character_id: int, depth: int):
+        """
+        returns the characters within depth conversations of character_id as
+        {character_id: distance} and the edges walked to reach them as
+        (character_id, partner_id, lines, conversations) with the smaller id
+        first
+        """
+        distances = {character_id: 0}
+        edges = {}
+        queue = deque([character_id])
+        while queue:
+            current = queue.popleft()
+            if distances[current] == depth:
+                continue
+            for partner_id, (lines, conversations) in self.neighbors(current).items():
+                edges[min(current, partner_id), max(current, partner_id)] = (lines, conversations)
+                if partner_id not in distances:
+                    distances[partner_id] = distances[current] + 1
+                    queue.append(partner_id)
+        return distances, [(a, b, *weights) for (a, b), weights in sorted(edges.items())]
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def build_graph(conn):
+    "returns a new graph over every conversation, through a synchronous connection"
+    num_lines = (
+        sqlalchemy.select(
+            db.lines.c.conversation_id,
+            sqlalchemy.func.count(db.lines.c.line_id).label("num_lines"),
+        )
+        .group_by(db.lines.c.conversation_id)
+        .subquery()
+    )
+    result = conn.execute(
+        sqlalchemy.select(
+            db.conversations.c.character1_id,
+            db.conversations.c.character2_id,
+            sqlalchemy.func.coalesce(sqlalchemy.func.sum(num_lines.c.num_lines), 0),
+            sqlalchemy.func.count(db.conversations.c.conversation_id),
+        )
+        .select_from(
+            db.conversations.outerjoin(
+                num_lines, num_lines.c.conversation_id == db.conversations.c.conversation_id
+            )
+        )
+        .group_by(db.conversations.c.character1_id, db.conversations.c.character2_id)
+    )
+    edges = {}
+    for character1_id, character2_id, lines, conversations in result:
+        for a, b in ((character1_id, character2_id), (character2_id, character1_id)):
+            edge = edges.setdefault((a, b), [0, 0])
+            edge[0] += lines
+            edge[1] += conversations
+    return InteractionGraph(edges)
+
+
+async def get_graph():
+    "returns the in-process graph, building it on first use"
+    global _graph
+    if _graph is None:
+        async with db.engine.connect() as conn:
+            graph = await conn.run_sync(build_graph)
+        with _graph_lock:
+            if _graph is None:
+                _graph = graph
+    return _graph
+
+
+def record_conversations(conversations):
+    "adds (character1_id, character2_id, lines) tuples to the graph if it is built"
+    with _graph_lock:
+        if _graph is not None:
+            for character1_id, character2_id, lines in conversations:
+                _graph.add(character1_id, character2_id, lines)
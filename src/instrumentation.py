@@ -0,0 +1,156 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import sqlalchemy
+from starlette.datastructures import MutableHeaders
+
+from src import metrics
+
+# Per request query accounting.
+#
+# Cursor events on the engine add every statement's duration and row count to
+# the RequestStats of the request being served, found through a context
+# variable that QueryStatsMiddleware sets. The middleware reports the totals
+# in a Server-Timing header and keeps the most recent requests of every route
+# for the percentiles served at /debug/queries, and feeds the latency
+# histograms and in-flight gauge exported at /metrics. Statements slower than
+# SLOW_QUERY_MS milliseconds are logged with their parameters.
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_MS", "200")) / 1000
+
+# requests kept per route for the percentiles
+SAMPLE_SIZE = 1000
+
+
+class RequestStats:
+    __slots__ = ("statements", "db_time", "rows")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+
+
+current = contextvars.ContextVar("request_stats", default=None)
+
+
+def fetched_rows(cursor):
+    "returns the rows a statement returned or changed, or 0 if unknown"
+    if cursor.rowcount >= 0:
+        return cursor.rowcount
+    # the async adapters buffer a SELECT's rows and leave rowcount at -1
+    rows = getattr(cursor, "_rows", None)
+    return len(rows) if rows is not None else 0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+        stats.rows += fetched_rows(cursor)
+    if elapsed >= SLOW_QUERY_SECONDS:
+        logger.warning(
+            "slow query (%.1f ms): %s parameters=%.500r", elapsed * 1000, statement, parameters
+        )
+
+
+def instrument(engine):
+    "installs the query hooks on an async engine"
+    sqlalchemy.event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+_samples = {}
+_samples_lock = threading.Lock()
+
+request_duration = metrics.Family(("route", "status"), metrics.Histogram)
+requests_in_flight = metrics.Gauge()
+
+
+def route_name(scope):
+    route = scope.get("route")
+    if route is not None:
+        return f"{scope['method']} {route.path}"
+    return f"{scope['method']} unmatched"
+
+
+class QueryStatsMiddleware:
+    "tracks the statements, database time and rows of every HTTP request"
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current.set(stats)
+        start = time.perf_counter()
+        # reported when the app fails before it starts a response
+        status = 500
+        requests_in_flight.inc()
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - start
+                MutableHeaders(scope=message).append(
+                    "Server-Timing",
+                    f'db;dur={stats.db_time * 1000:.1f};desc="{stats.statements} statements, '
+                    f'{stats.rows} rows", total;dur={elapsed * 1000:.1f}',
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current.reset(token)
+            requests_in_flight.dec()
+            elapsed = time.perf_counter() - start
+            sample = (elapsed, stats.statements, stats.db_time, stats.rows)
+            name = route_name(scope)
+            request_duration.labels(name, str(status)).observe(elapsed)
+            with _samples_lock:
+                if name not in _samples:
+                    _samples[name] = deque(maxlen=SAMPLE_SIZE)
+                _samples[name].append(sample)
+
+
+def percentiles(values):
+    values = sorted(values)
+    return {
+        f"p{p}": round(values[min(len(values) - 1, int(len(values) * p / 100))], 2)
+        for p in (50, 95, 99)
+    }
+
+
+def route_stats():
+    "returns percentiles of the recent requests of every route"
+    with _samples_lock:
+        samples = {name: list(requests) for name, requests in _samples.items()}
+    report = {}
+    for name, requests in sorted(samples.items()):
+        durations, statements, db_times, rows = zip(*requests)
+        report[name] = {
+            "requests": len(requests),
+            "duration_ms": percentiles([d * 1000 for d in durations]),
+            "db_ms": percentiles([d * 1000 for d in db_times]),
+            "statements": percentiles(statements),
+            "rows": percentiles(rows),
+        }
+    return report
@@ -0,0 +1,156 @@
+import bisect
+import os
+import threading
+
+# Small in-process instruments for the debug and metrics endpoints.
+#
+# Instruments are updated on the request path, so updates take no lock: each
+# thread writes its own shard of slots and readers add the shards up. A read
+# racing an update may miss it, which a scrape tolerates. The only lock is
+# taken the first time a thread touches an instrument.
+
+# upper bounds in seconds, from a fast pool checkout up to a stalled request
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Sharded:
+    "per-thread slots that only their own thread writes"
+
+    def __init__(self, size: int):
+        self.size = size
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = [0] * self.size
+            with self.lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def totals(self):
+        totals = [0] * self.size
+        for shard in list(self.shards):
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+
+class Counter(Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self.shard()[0] += amount
+
+    def value(self):
+        return self.totals()[0]
+
+
+class Gauge(Counter):
+    "a counter that can also go down, such as requests in flight"
+
+    def dec(self, amount=1):
+        self.shard()[0] -= amount
+
+
+class Histogram(Sharded):
+    "counts observations into fixed buckets, Prometheus style"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # a count per bucket, one for +Inf, then the sum
+        super().__init__(len(self.buckets) + 2)
+
+    def observe(self, value: float):
+        shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self):
+        "returns cumulative bucket counts keyed by upper bound plus count and sum"
+        totals = self.totals()
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ("+Inf",), totals):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"buckets": buckets, "count": cumulative, "sum": totals[-1]}
+
+
+class Family:
+    "instruments of one kind keyed by label values"
+
+    def __init__(self, labelnames, factory):
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def items(self):
+        "returns (labels dict, instrument) pairs"
+        return [
+            (dict(zip(self.labelnames, values)), child)
+            for values, child in sorted(self.children.copy().items())
+        ]
+
+
+def resident_memory():
+    "returns the resident set size of this process in bytes, or None"
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Exposition:
+    "builds a page in the Prometheus text format"
+
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, kind: str, name: str, help: str, samples):
+        "adds a counter or gauge from (labels dict, value) pairs"
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{format_labels(labels)} {value}")
+
+    def histogram(self, name: str, help: str, samples):
+        "adds a histogram from (labels dict, Histogram) pairs"
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in samples:
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot["buckets"].items():
+                bucket_labels = {**labels, "le": bound}
+                self.lines.append(f"{name}_bucket{format_labels(bucket_labels)} {count}")
+            self.lines.append(f"{name}_sum{format_labels(labels)} {snapshot['sum']}")
+            self.lines.append(f"{name}_count{format_labels(labels)} {snapshot['count']}")
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
@@ -0,0 +1,245 @@
+"""
+Applies the schema migrations a database hasn't had yet.
+
+    python -m src.migrations
+    python -m src.migrations --status
+
+Run it when deploying, before the new release starts serving; the API
+doesn't apply migrations itself.
+"""
+import argparse
+import asyncio
+import datetime
+
+import sqlalchemy
+
+from src import database as db
+from src import stats
+
+# Versioned schema changes, and the record of every index the API relies on.
+#
+# Each migration is a function of a synchronous connection registered with a
+# version number; versions are applied in order, once, and recorded in the
+# schema_migrations table. Migrations must not change once released: a
+# change to the schema is a new version. Postgres only gets extensions and
+# index types it supports, so a migration checks the dialect where they
+# differ. The memory backend applies the same migrations right after loading
+# the corpus, which also builds its indexes after the bulk insert rather than
+# during it.
+#
+# A migration runs in a transaction of its own, unless it is registered with
+# transaction=False: on Postgres those build their indexes CONCURRENTLY, so
+# the tables stay writable while they build, which can't happen inside a
+# transaction. Such a migration must be safe to run again after failing
+# partway, which create_index takes care of.
+
+# kept out of db.metadata_obj, so create_all leaves it alone
+schema_migrations = sqlalchemy.Table(
+    "schema_migrations",
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.Text, nullable=False),
+    sqlalchemy.Column("applied_at", sqlalchemy.DateTime, nullable=False),
+)
+
+# serializes concurrent runs on Postgres
+LOCK_KEY = 7265431
+
+MIGRATIONS = []
+
+
+def migration(version: int, name: str, transaction: bool = True):
+    def register(upgrade):
+        MIGRATIONS.append((version, name, upgrade, transaction))
+        return upgrade
+
+    return register
+
+
+def execute(conn, *statements):
+    for statement in statements:
+        conn.execute(sqlalchemy.text(statement))
+
+
+def is_postgres(conn):
+    return conn.dialect.name == "postgresql"
+
+
+def create_index(conn, name, definition):
+    """
+    creates the index name ON definition unless it exists. Postgres builds it
+    CONCURRENTLY, outside a transaction; a concurrent build that failed
+    leaves an invalid index behind, which is dropped and built again.
+    """
+    if not is_postgres(conn):
+        execute(conn, f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+        return
+    invalid = conn.execute(
+        sqlalchemy.text(
+            "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+        ),
+        {"name": name},
+    ).scalar()
+    if invalid:
+        execute(conn, f"DROP INDEX CONCURRENTLY {name}")
+    execute(conn, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+
+@migration(1, "statistics tables")
+def statistics_tables(conn):
+    # the line counts src.stats maintains, indexed by the next migration and
+    # filled once here; the memory backend fills them while loading
+    for table in (db.character_stats, db.movie_stats):
+        table.create(conn, checkfirst=True)
+    stats.populate(conn)
+
+
+@migration(2, "lookup indexes", transaction=False)
+def lookup_indexes(conn):
+    # the joins of every router go through these, as do get_movie's top
+    # characters and list_characters' number_of_lines sort
+    for name, definition in (
+        ("ix_characters_movie_id", "characters (movie_id)"),
+        ("ix_conversations_movie_id", "conversations (movie_id)"),
+        ("ix_conversations_character1_id", "conversations (character1_id)"),
+        ("ix_conversations_character2_id", "conversations (character2_id)"),
+        ("ix_lines_character_id", "lines (character_id)"),
+        ("ix_lines_movie_id", "lines (movie_id)"),
+        ("ix_character_stats_num_lines", "character_stats (num_lines)"),
+        ("ix_character_stats_movie_id_num_lines", "character_stats (movie_id, num_lines)"),
+        # transcripts read a conversation's lines in order. line_text stays
+        # out of the index: a long line would exceed the btree row size
+        ("ix_lines_transcript", "lines (conversation_id, line_sort)"),
+    ):
+        create_index(conn, name, definition)
+
+
+@migration(3, "text search indexes", transaction=False)
+def text_search_indexes(conn):
+    # other databases search lines through the in-process index of src.search
+    if not is_postgres(conn):
+        return
+    execute(conn, "CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    create_index(conn, "ix_lines_line_text_trgm", "lines USING gin (line_text gin_trgm_ops)")
+    create_index(
+        conn, "ix_lines_line_text_tsv", "lines USING gin (to_tsvector('english', line_text))"
+    )
+
+
+@migration(4, "title and name indexes", transaction=False)
+def title_and_name_indexes(conn):
+    # the list endpoints sort by title and name with the id as tie breaker
+    create_index(conn, "ix_movies_title_movie_id", "movies (title, movie_id)")
+    create_index(conn, "ix_characters_name_character_id", "characters (name, character_id)")
+    # and filter them with ILIKE '%...%', which only a trigram index can serve
+    if is_postgres(conn):
+        create_index(conn, "ix_movies_title_trgm", "movies USING gin (title gin_trgm_ops)")
+        create_index(
+            conn, "ix_characters_name_trgm", "characters USING gin (name gin_trgm_ops)"
+        )
+
+
+@migration(5, "generated ids")
+def generated_ids(conn):
+    # ids of rows created through the API are assigned by the database;
+    # SQLite's INTEGER PRIMARY KEY columns assign them already
+    if not is_postgres(conn):
+        return
+    for table, column in (("conversations", "conversation_id"), ("lines", "line_id")):
+        find_sequence = sqlalchemy.text("SELECT pg_get_serial_sequence(:table, :column)")
+        params = {"table": table, "column": column}
+        sequence = conn.execute(find_sequence, params).scalar()
+        if sequence is None:
+            execute(
+                conn,
+                f"ALTER TABLE {table} ALTER COLUMN {column} ADD GENERATED BY DEFAULT AS IDENTITY",
+            )
+            # no one else sees the new sequence until this commits
+            conn.execute(
+                sqlalchemy.text(
+                    f"SELECT setval(pg_get_serial_sequence(:table, :column), "
+                    f"(SELECT coalesce(max({column}), 0) + 1 FROM {table}), false)"
+                ),
+                params,
+            )
+
+
+def applied(conn):
+    "returns the applied versions as {version: (name, applied_at)}"
+    schema_migrations.create(conn, checkfirst=True)
+    result = conn.execute(sqlalchemy.select(schema_migrations))
+    versions = {row.version: (row.name, row.applied_at) for row in result}
+    conn.commit()
+    return versions
+
+
+def apply(conn):
+    """
+    applies the pending migrations in order through a synchronous connection
+    that isn't in a transaction, committing each, and returns their versions
+    """
+    postgres = is_postgres(conn)
+    if postgres:
+        # held by the session, across the commits of the migrations
+        conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_lock(LOCK_KEY)))
+        conn.commit()
+    try:
+        done = applied(conn)
+        versions = []
+        for version, name, upgrade, transaction in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version in done:
+                continue
+            if transaction or not postgres:
+                upgrade(conn)
+            else:
+                conn.execution_options(isolation_level="AUTOCOMMIT")
+                try:
+                    upgrade(conn)
+                finally:
+                    # ends the transaction SQLAlchemy began, which has nothing to undo
+                    conn.rollback()
+                    conn.execution_options(isolation_level=conn.default_isolation_level)
+            conn.execute(
+                sqlalchemy.insert(schema_migrations).values(
+                    version=version, name=name, applied_at=datetime.datetime.utcnow()
+                )
+            )
+            conn.commit()
+            versions.append(version)
+        if versions:
+            # planner statistics, without which SQLite ignores the new indexes
+            execute(conn, "ANALYZE")
+            conn.commit()
+        return versions
+    finally:
+        if postgres:
+            conn.rollback()
+            conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(LOCK_KEY)))
+            conn.commit()
+
+
+async def migrate():
+    "applies the pending migrations to the configured database"
+    async with db.engine.connect() as conn:
+        return await conn.run_sync(apply)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--status", action="store_true", help="list migrations without applying them")
+    args = parser.parse_args()
+
+    if args.status:
+        async with db.engine.connect() as conn:
+            done = await conn.run_sync(applied)
+        for version, name, _, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+            state = f"applied {done[version][1]:%Y-%m-%d %H:%M}" if version in done else "pending"
+            print(f"{version:4} {name:40} {state}")
+    else:
+        versions = await migrate()
+        print(f"applied {versions}" if versions else "up to date")
+    await db.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
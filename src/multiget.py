@@ -0,0 +1,52 @@
+import sqlalchemy
+from fastapi import HTTPException
+
+from src import database as db
+
+# Helpers shared by the endpoints that fetch many rows by id.
+#
+# Ids are passed as one comma separated query parameter, `?ids=3,1,2`, and
+# resolved with a single query per table. Responses list the rows found in
+# the order the ids were requested and the ids that matched nothing.
+#
+# On Postgres the ids go to the database as one array parameter, which keeps
+# the statement text, and so asyncpg's prepared statement, the same whatever
+# the number of ids.
+
+# ids accepted per request
+MAX_IDS = 100
+
+
+def parse_ids(ids: str):
+    "returns the distinct ids of a comma separated list in the order given"
+    try:
+        values = [int(value) for value in ids.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid ids")
+    values = list(dict.fromkeys(values))
+    if not values:
+        raise HTTPException(status_code=400, detail="No ids given")
+    if len(values) > MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_IDS} ids are allowed")
+    return values
+
+
+def any_of(column, ids):
+    "returns a filter matching column against any of ids"
+    if db.backend == "postgres":
+        array = sqlalchemy.bindparam(
+            None, ids, type_=sqlalchemy.ARRAY(sqlalchemy.Integer)
+        )
+        return column == sqlalchemy.any_(array)
+    return column.in_(ids)
+
+
+def in_order(ids, found: dict):
+    """
+    returns the values of found, which maps ids to results, in the order of
+    ids along with the ids it lacks
+    """
+    return {
+        "results": [found[id] for id in ids if id in found],
+        "missing": [id for id in ids if id not in found],
+    }
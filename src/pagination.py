@@ -0,0 +1,70 @@
+import base64
+import binascii
+import json
+
+import sqlalchemy
+from fastapi import HTTPException
+
+# Keyset pagination helpers shared by the list endpoints.
+#
+# A sort is described as a list of (column, descending, field) keys where
+# field is the name of the column in the result rows. The last key must be a
+# unique id so that the ordering is total. A cursor is the opaque encoding of
+# the sort key values of the last row on a page; the next page is everything
+# strictly after it, which lets the database seek with an index instead of
+# producing and discarding `offset` rows. All sort keys are NOT NULL.
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values):
+    "returns the opaque cursor for a list of sort key values"
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, keys):
+    "returns the sort key values stored in a cursor built for keys"
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def after(keys, values):
+    """
+    returns a filter matching rows that sort strictly after values, expanded
+    as (k1 > v1) or (k1 = v1 and k2 > v2) or ... so mixed sort directions work
+    """
+    # cast the values back to the column types so a float4 rating compares
+    # equal to its own round-tripped value
+    values = [sqlalchemy.cast(value, column.type) for (column, _, _), value in zip(keys, values)]
+
+    clauses = []
+    for i, (column, descending, _) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        beyond = column < values[i] if descending else column > values[i]
+        clauses.append(sqlalchemy.and_(*equal, beyond))
+    return sqlalchemy.or_(*clauses)
+
+
+def paginate(stmt, keys, cursor, limit: int, offset: int):
+    "orders stmt by keys and applies the cursor, limit and offset"
+    stmt = stmt.order_by(
+        *(sqlalchemy.desc(column) if descending else column for column, descending, _ in keys)
+    )
+    if cursor:
+        stmt = stmt.where(after(keys, decode_cursor(cursor, keys)))
+    return stmt.limit(limit).offset(offset)
+
+
+def next_cursor(rows, keys, limit: int):
+    "returns the cursor for the page after rows, or None on the last page"
+    if len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor([getattr(last, field) for _, _, field in keys])
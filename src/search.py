@@ -0,0 +1,138 @@
+import math
+import re
+import threading
+from array import array
+
+import sqlalchemy
+
+from src import database as db
+
+# Text search over lines.line_text.
+#
+# On Postgres the search runs in the database, backed by a pg_trgm index (which
+# also serves the substring `text` filter of /lines/) and an english tsvector
+# index used for relevance ranking, both created by src.migrations. Other databases get an in-process inverted
+# index built from the lines table on first use and kept current by
+# add_conversation. Relevance there is BM25 with binary term frequency, which
+# suits one-sentence lines.
+
+TOKEN = re.compile(r"[a-z0-9']+")
+
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str):
+    return TOKEN.findall(text.lower())
+
+
+def uses_database_search():
+    return db.engine.dialect.name == "postgresql"
+
+
+def ts_query(text: str):
+    return sqlalchemy.func.plainto_tsquery("english", text)
+
+
+def ts_match(text: str):
+    "filter for lines matching every word of text, served by the tsvector index"
+    return sqlalchemy.func.to_tsvector("english", db.lines.c.line_text).op("@@")(
+        ts_query(text)
+    )
+
+
+def ts_rank(text: str):
+    return sqlalchemy.func.ts_rank(
+        sqlalchemy.func.to_tsvector("english", db.lines.c.line_text),
+        ts_query(text),
+        type_=sqlalchemy.REAL,
+    )
+
+
+class InvertedIndex:
+    "token -> line id postings plus the per line data needed for ranking"
+
+    def __init__(self):
+        self.postings = {}
+        self.lengths = array("i")
+        self.movie_ids = array("i")
+        self.num_lines = 0
+        self.total_length = 0
+
+    def add(self, line_id: int, movie_id: int, text: str):
+        tokens = tokenize(text)
+        if line_id >= len(self.lengths):
+            grow = line_id + 1 - len(self.lengths)
+            self.lengths.extend([0] * grow)
+            self.movie_ids.extend([-1] * grow)
+        self.lengths[line_id] = len(tokens)
+        self.movie_ids[line_id] = movie_id
+        self.num_lines += 1
+        self.total_length += len(tokens)
+        for token in set(tokens):
+            self.postings.setdefault(token, array("i")).append(line_id)
+
+    def search(self, text: str, movie_ids=None):
+        """
+        returns (score, line_id) pairs for the lines containing every token
+        of text, best match first. movie_ids optionally restricts the movies.
+        """
+        tokens = set(tokenize(text))
+        if not tokens:
+            return []
+        postings = [self.postings.get(token, ()) for token in tokens]
+        postings.sort(key=len)
+        matches = set(postings[0])
+        for other in postings[1:]:
+            matches.intersection_update(other)
+        if movie_ids is not None:
+            matches = {line_id for line_id in matches if self.movie_ids[line_id] in movie_ids}
+
+        idf = sum(
+            math.log(1 + (self.num_lines - len(p) + 0.5) / (len(p) + 0.5)) for p in postings
+        )
+        average_length = self.total_length / max(self.num_lines, 1)
+        scored = [
+            (
+                idf * (K1 + 1) / (1 + K1 * (1 - B + B * self.lengths[line_id] / average_length)),
+                line_id,
+            )
+            for line_id in matches
+        ]
+        scored.sort(key=lambda match: (-match[0], match[1]))
+        return scored
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def build_index(conn):
+    "returns a new in-process index over every row of the lines table"
+    index = InvertedIndex()
+    result = conn.execute(
+        sqlalchemy.select(db.lines.c.line_id, db.lines.c.movie_id, db.lines.c.line_text)
+    )
+    for row in result:
+        index.add(row.line_id, row.movie_id, row.line_text or "")
+    return index
+
+
+async def get_index():
+    "returns the in-process index, building it from the lines table on first use"
+    global _index
+    if _index is None:
+        async with db.engine.connect() as conn:
+            index = await conn.run_sync(build_index)
+        with _index_lock:
+            if _index is None:
+                _index = index
+    return _index
+
+
+def record_lines(lines):
+    "adds (line_id, movie_id, text) tuples to the in-process index if it is built"
+    with _index_lock:
+        if _index is not None:
+            for line_id, movie_id, text in lines:
+                _index.add(line_id, movie_id, text)
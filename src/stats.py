@@ -0,0 +1,202 @@
+from collections import Counter
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
+
+from src import database as db
+
+
+def refresh(conn):
+    "recomputes every row of the statistics tables from lines and conversations"
+    conn.execute(sqlalchemy.delete(db.character_stats))
+    conn.execute(
+        sqlalchemy.insert(db.character_stats).from_select(
+            ["character_id", "movie_id", "num_lines"],
+            sqlalchemy.select(
+                db.characters.c.character_id,
+                db.characters.c.movie_id,
+                sqlalchemy.func.count(db.lines.c.line_id),
+            )
+            .select_from(
+                db.characters.outerjoin(
+                    db.lines, db.characters.c.character_id == db.lines.c.character_id
+                )
+            )
+            .group_by(db.characters.c.character_id, db.characters.c.movie_id),
+        )
+    )
+
+    conn.execute(sqlalchemy.delete(db.movie_stats))
+    conn.execute(
+        sqlalchemy.insert(db.movie_stats).from_select(
+            ["movie_id", "num_lines", "num_conversations"],
+            sqlalchemy.select(
+                db.movies.c.movie_id,
+                sqlalchemy.select(sqlalchemy.func.count(db.lines.c.line_id))
+                .where(db.lines.c.movie_id == db.movies.c.movie_id)
+                .scalar_subquery(),
+                sqlalchemy.select(sqlalchemy.func.count(db.conversations.c.conversation_id))
+                .where(db.conversations.c.movie_id == db.movies.c.movie_id)
+                .scalar_subquery(),
+            ),
+        )
+    )
+
+
+def populate(conn):
+    "fills the statistics tables when they are empty"
+    populated = conn.execute(sqlalchemy.select(db.character_stats.c.character_id).limit(1)).first()
+    if populated is None:
+        refresh(conn)
+
+
+def upsert(conn, table):
+    "returns an INSERT into table that takes an ON CONFLICT clause on conn's database"
+    if conn.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def record_conversation(conn, movie_id: int, lines, num_conversations: int = 1):
+    """
+    applies newly inserted conversations to the statistics tables. lines is
+    an iterable of the character ids that spoke each line, across all of them.
+    Counts are added to the existing rows, which are created when missing.
+    """
+    line_counts = Counter(lines)
+
+    if line_counts:
+        stmt = upsert(conn, db.character_stats)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[db.character_stats.c.character_id],
+                set_={"num_lines": db.character_stats.c.num_lines + stmt.excluded.num_lines},
+            ),
+            [
+                {"character_id": character_id, "movie_id": movie_id, "num_lines": num_lines}
+                for character_id, num_lines in line_counts.items()
+            ],
+        )
+    stmt = upsert(conn, db.movie_stats).values(
+        movie_id=movie_id,
+        num_lines=sum(line_counts.values()),
+        num_conversations=num_conversations,
+    )
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[db.movie_stats.c.movie_id],
+            set_={
+                "num_lines": db.movie_stats.c.num_lines + stmt.excluded.num_lines,
+                "num_conversations": db.movie_stats.c.num_conversations
+                + stmt.excluded.num_conversations,
+            },
+        )
+    )
+
+
+def movie_analytics(conn, movie_id=None):
+    """
+    returns dialogue statistics keyed by movie id, for every movie or just
+    movie_id. Each statistic is a single grouped aggregate over all the movies
+    asked for, so the cost doesn't grow with the number of movies.
+    """
+
+    def only_movie(stmt, column):
+        return stmt if movie_id is None else stmt.where(column == movie_id)
+
+    analytics = {}
+    for row in conn.execute(
+        only_movie(
+            sqlalchemy.select(
+                db.movies.c.movie_id,
+                db.movies.c.title,
+                db.movie_stats.c.num_lines,
+                db.movie_stats.c.num_conversations,
+            )
+            .select_from(
+                db.movies.outerjoin(
+                    db.movie_stats, db.movie_stats.c.movie_id == db.movies.c.movie_id
+                )
+            )
+            .order_by(db.movies.c.movie_id),
+            db.movies.c.movie_id,
+        )
+    ):
+        analytics[row.movie_id] = {
+            "movie_id": row.movie_id,
+            "title": row.title,
+            "num_lines": row.num_lines or 0,
+            "num_conversations": row.num_conversations or 0,
+            "num_characters": 0,
+            "average_line_length": None,
+            "lines_by_gender": [],
+            "conversation_lengths": {},
+        }
+
+    for row in conn.execute(
+        only_movie(
+            sqlalchemy.select(
+                db.characters.c.movie_id,
+                db.characters.c.gender,
+                sqlalchemy.func.count(db.characters.c.character_id).label("num_characters"),
+                sqlalchemy.func.coalesce(
+                    sqlalchemy.func.sum(db.character_stats.c.num_lines), 0
+                ).label("num_lines"),
+            )
+            .select_from(
+                db.characters.outerjoin(
+                    db.character_stats,
+                    db.character_stats.c.character_id == db.characters.c.character_id,
+                )
+            )
+            .group_by(db.characters.c.movie_id, db.characters.c.gender)
+            .order_by(db.characters.c.movie_id, db.characters.c.gender),
+            db.characters.c.movie_id,
+        )
+    ):
+        if row.movie_id in analytics:
+            movie = analytics[row.movie_id]
+            movie["num_characters"] += row.num_characters
+            movie["lines_by_gender"].append(
+                {"gender": row.gender, "num_characters": row.num_characters, "num_lines": row.num_lines}
+            )
+
+    for row in conn.execute(
+        only_movie(
+            sqlalchemy.select(
+                db.lines.c.movie_id,
+                sqlalchemy.func.avg(sqlalchemy.func.length(db.lines.c.line_text)).label("average"),
+            ).group_by(db.lines.c.movie_id),
+            db.lines.c.movie_id,
+        )
+    ):
+        if row.movie_id in analytics and row.average is not None:
+            analytics[row.movie_id]["average_line_length"] = round(float(row.average), 2)
+
+    # conversations per length, from the line count of each conversation
+    lengths = only_movie(
+        sqlalchemy.select(
+            db.conversations.c.movie_id,
+            sqlalchemy.func.count(db.lines.c.line_id).label("length"),
+        )
+        .select_from(
+            db.conversations.outerjoin(
+                db.lines, db.lines.c.conversation_id == db.conversations.c.conversation_id
+            )
+        )
+        .group_by(db.conversations.c.movie_id, db.conversations.c.conversation_id),
+        db.conversations.c.movie_id,
+    ).subquery()
+    for row in conn.execute(
+        sqlalchemy.select(
+            lengths.c.movie_id,
+            lengths.c.length,
+            sqlalchemy.func.count().label("num_conversations"),
+        )
+        .group_by(lengths.c.movie_id, lengths.c.length)
+        .order_by(lengths.c.movie_id, lengths.c.length)
+    ):
+        if row.movie_id in analytics:
+            analytics[row.movie_id]["conversation_lengths"][str(row.length)] = row.num_conversations
+
+    return analytics
@@ -0,0 +1,134 @@
+import csv
+import io
+import json
+import re
+
+from src import encoding
+
+# Incremental decoding of request bodies holding many JSON items, so large
+# uploads can be processed as they arrive instead of being buffered whole,
+# and the encoders for streamed responses.
+
+STRUCTURAL = re.compile(rb'["\\\[\]{},]')
+QUOTE, BACKSLASH, COMMA = ord('"'), ord("\\"), ord(",")
+OPENERS, CLOSERS = (ord("["), ord("{")), (ord("]"), ord("}"))
+
+
+class JsonArraySplitter:
+    "splits the bytes of a JSON array into the raw bytes of its items"
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False
+        self.pending = bytearray()
+
+    def feed(self, data: bytes):
+        items = []
+        item_start = 0
+        pos = 0
+        if self.escape:
+            self.escape = False
+            pos = 1
+
+        while not self.done:
+            match = STRUCTURAL.search(data, pos)
+            if match is None:
+                break
+            i = match.start()
+            c = data[i]
+            pos = i + 1
+
+            if self.in_string:
+                if c == BACKSLASH:
+                    if pos < len(data):
+                        pos += 1
+                    else:
+                        self.escape = True
+                elif c == QUOTE:
+                    self.in_string = False
+            elif c == QUOTE:
+                self.in_string = True
+            elif c in OPENERS:
+                self.depth += 1
+                if self.depth == 1:
+                    item_start = pos
+            elif c in CLOSERS:
+                self.depth -= 1
+                if self.depth == 0:
+                    items.append(self._take(data[item_start:i]))
+                    self.done = True
+            elif c == COMMA and self.depth == 1:
+                items.append(self._take(data[item_start:i]))
+                item_start = pos
+
+        if self.depth >= 1 and not self.done:
+            self.pending += data[item_start:]
+        return [item for item in items if item.strip()]
+
+    def _take(self, tail):
+        item = bytes(self.pending) + tail
+        self.pending.clear()
+        return item
+
+
+async def iter_json_items(chunks):
+    """
+    yields (item, error) for every item of a streamed body that holds either
+    newline-delimited JSON or a single JSON array. item is the decoded value,
+    or None with error describing why it couldn't be decoded.
+    """
+    buffer = bytearray()
+    splitter = None
+    is_array = None
+
+    def decode(raw):
+        try:
+            return json.loads(raw), None
+        except ValueError as e:
+            return None, f"Invalid JSON: {e}"
+
+    async for chunk in chunks:
+        if is_array is None:
+            buffer += chunk
+            stripped = buffer.lstrip()
+            if not stripped:
+                continue
+            is_array = stripped[:1] == b"["
+            chunk = bytes(buffer)
+            buffer.clear()
+            if is_array:
+                splitter = JsonArraySplitter()
+
+        if is_array:
+            for raw in splitter.feed(chunk):
+                yield decode(raw)
+        else:
+            buffer += chunk
+            *complete, rest = buffer.split(b"\n")
+            buffer = bytearray(rest)
+            for raw in complete:
+                if raw.strip():
+                    yield decode(raw)
+
+    if is_array:
+        if not splitter.done:
+            yield None, "Invalid JSON: unterminated array"
+    elif buffer.strip():
+        yield decode(buffer)
+
+
+def ndjson_chunk(rows) -> bytes:
+    "encodes a batch of result rows as newline-delimited JSON"
+    return b"".join(encoding.dumps(record) + b"\n" for record in encoding.records(rows))
+
+
+def csv_chunk(rows, header=None) -> bytes:
+    "encodes a batch of result rows as CSV, preceded by header if given"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header is not None:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode("utf-8")
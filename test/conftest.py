@@ -0,0 +1,148 @@
+import asyncio
+import contextlib
+import os
+
+import pytest
+import sqlalchemy
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from test import corpus
+
+# The suite runs against a local in-memory SQLite database built from the
+# bundled CSVs and a generated lines fixture, with every test in a
+# transaction that is rolled back afterwards, so tests need no network and
+# can run in parallel with pytest -n auto. Set MOVIE_API_TEST_DATABASE=live to
+# run against the database configured in .env instead, which the tests
+# marked live need. Golden files come in two sets, one recorded from each
+# database, and corpus.golden picks the one in use.
+LIVE = corpus.LIVE
+
+if LIVE:
+    # TestClient runs each request on its own event loop when it isn't used
+    # as a context manager, and asyncpg connections can't move between
+    # loops. Opening a connection per checkout keeps the module level
+    # clients working.
+    os.environ.setdefault("DB_POOL_MODE", "null")
+else:
+    os.environ["MOVIE_API_BACKEND"] = "memory"
+    os.environ["MOVIE_API_DATA_DIR"] = corpus.data_dir()
+
+from src import cache, graph, instrumentation, search  # noqa: E402
+from src import database as db  # noqa: E402
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "live: compares against data recorded from the live database"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if LIVE:
+        return
+    skip = pytest.mark.skip(reason="needs MOVIE_API_TEST_DATABASE=live")
+    for item in items:
+        if "live" in item.keywords:
+            item.add_marker(skip)
+
+
+def _autocommit_driver(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def _emit_begin(conn):
+    # straight to the driver, so the query statistics only count real work
+    cursor = conn.connection.cursor()
+    cursor.execute("BEGIN")
+    cursor.close()
+
+
+def build_test_engine():
+    """
+    returns an engine on the memory backend's database for the tests alone.
+    The driver's own transaction handling breaks SAVEPOINT, which the tests
+    use to roll every test back, so this engine lets SQLAlchemy emit BEGIN
+    itself. The app's engine is left as it is served.
+    """
+    loader = db.lazy("memory_loader")
+    engine = create_async_engine(
+        str(loader.url).replace("sqlite://", "sqlite+aiosqlite://", 1),
+        poolclass=sqlalchemy.pool.StaticPool,
+    )
+    sqlalchemy.event.listen(engine.sync_engine, "connect", _autocommit_driver)
+    sqlalchemy.event.listen(engine.sync_engine, "begin", _emit_begin)
+    instrumentation.instrument(engine)
+    return engine
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    engine = None if LIVE else build_test_engine()
+    yield engine
+    # the driver's connection threads would keep the process alive
+    if engine is not None:
+        asyncio.run(engine.dispose())
+    asyncio.run(db.dispose())
+
+
+class RollbackEngine:
+    """
+    stands in for the engine during a test: every request gets the same
+    connection, inside a transaction the test rolls back, and begin() opens a
+    savepoint in it instead of a transaction of its own
+    """
+
+    def __init__(self, engine, conn):
+        self.engine = engine
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    @contextlib.asynccontextmanager
+    async def connect(self):
+        yield self.conn
+
+    @contextlib.asynccontextmanager
+    async def begin(self):
+        async with self.conn.begin_nested():
+            yield self.conn
+
+
+async def total_changes(conn):
+    return (await conn.get_raw_connection()).driver_connection.total_changes
+
+
+@pytest.fixture(autouse=True)
+def rollback(database):
+    if LIVE:
+        yield
+        return
+
+    engine = database
+    served = db.lazy("engine")
+
+    async def open():
+        conn = await engine.connect()
+        await conn.begin()
+        return conn, await total_changes(conn)
+
+    conn, changes = asyncio.run(open())
+    db.override("engine", RollbackEngine(engine, conn))
+    try:
+        yield
+    finally:
+
+        async def close():
+            wrote = await total_changes(conn) != changes
+            await conn.rollback()
+            await conn.close()
+            return wrote
+
+        wrote = asyncio.run(close())
+        db.override("engine", served)
+        cache.responses.clear()
+        if wrote:
+            # the in-process indexes saw the rolled back rows
+            graph._graph = None
+            search._index = None
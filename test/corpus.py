@@ -0,0 +1,89 @@
+import csv
+import hashlib
+import os
+import random
+import tempfile
+
+# The local test database: the movies, characters and conversations CSVs
+# bundled with the repo, plus a lines.csv generated from the conversations
+# since the real lines are only in the live database. Generation is seeded,
+# so every run and every worker sees the same lines.
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+BUNDLED = ["movies.csv", "characters.csv", "conversations.csv"]
+
+# bump to regenerate existing fixtures after changing the generator, and
+# re-record the golden files under test/local
+VERSION = 1
+
+# set MOVIE_API_TEST_DATABASE=live to run the tests against the database
+# configured in .env instead
+LIVE = os.environ.get("MOVIE_API_TEST_DATABASE") == "live"
+
+WORDS = (
+    "i you we they what why where when know think want need go come tell "
+    "money time night home car school dad mom friend party dog cat never "
+    "always maybe really just now here there okay yeah no right"
+).split()
+
+
+def generate_lines(conversations, seed: int = 0):
+    "yields line rows for conversation rows, alternating their two characters"
+    rng = random.Random(seed)
+    line_id = 0
+    for conversation in conversations:
+        speakers = (conversation["character1_id"], conversation["character2_id"])
+        for line_sort in range(1, rng.randint(2, 6) + 1):
+            words = rng.choices(WORDS, k=rng.randint(2, 10))
+            yield {
+                "line_id": line_id,
+                "character_id": speakers[(line_sort - 1) % 2],
+                "movie_id": conversation["movie_id"],
+                "conversation_id": conversation["conversation_id"],
+                "line_sort": line_sort,
+                "line_text": " ".join(words).capitalize() + rng.choice(".?!"),
+            }
+            line_id += 1
+
+
+def golden(name: str):
+    """
+    returns the path of a golden file: the one recorded from the live
+    database, or from the local one under test/local
+    """
+    return os.path.join("test", name) if LIVE else os.path.join("test", "local", name)
+
+
+def data_dir():
+    """
+    returns a directory with the bundled CSVs and the generated lines.csv,
+    creating it on first use. Concurrent test workers may race to create it,
+    so every file is written under a temporary name and renamed into place.
+    """
+    stamp = hashlib.sha1(str(VERSION).encode())
+    for name in BUNDLED:
+        stamp.update(str(os.stat(os.path.join(ROOT, name)).st_mtime_ns).encode())
+    directory = os.path.join(tempfile.gettempdir(), f"movie_api_corpus_{stamp.hexdigest()[:12]}")
+    if os.path.exists(os.path.join(directory, "lines.csv")):
+        return directory
+
+    os.makedirs(directory, exist_ok=True)
+    for name in BUNDLED:
+        link = os.path.join(directory, name)
+        if not os.path.exists(link):
+            staged = f"{link}.{os.getpid()}"
+            os.symlink(os.path.abspath(os.path.join(ROOT, name)), staged)
+            os.replace(staged, link)
+
+    with open(os.path.join(ROOT, "conversations.csv"), encoding="utf8") as f:
+        conversations = list(csv.DictReader(f, skipinitialspace=True))
+    staged = os.path.join(directory, f"lines.csv.{os.getpid()}")
+    with open(staged, "w", encoding="utf8", newline="") as f:
+        writer = csv.DictWriter(
+            f,
+            ["line_id", "character_id", "movie_id", "conversation_id", "line_sort", "line_text"],
+        )
+        writer.writeheader()
+        writer.writerows(generate_lines(conversations))
+    os.replace(staged, os.path.join(directory, "lines.csv"))
+    return directory
@@ -1,6 +1,7 @@
 from fastapi.testclient import TestClient
 
 from src.api.server import app
+from test import corpus
 
 import json
 
@@ -11,7 +12,7 @@ def test_get_character():
     response = client.get("/characters/7421")
     assert response.status_code == 200
 
-    with open("test/characters/7421.json", encoding="utf-8") as f:
+    with open(corpus.golden("characters/7421.json"), encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
 
@@ -19,7 +20,7 @@ def test_characters():
     response = client.get("/characters/")
     assert response.status_code == 200
 
-    with open("test/characters/root.json", encoding="utf-8") as f:
+    with open(corpus.golden("characters/root.json"), encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
 # New test case (includes multiple conversation partners)
@@ -27,7 +28,7 @@ def test_get_character2():
     response = client.get("/characters/2")
     assert response.status_code == 200
 
-    with open("test/characters/2.json", encoding="utf-8") as f:
+    with open(corpus.golden("characters/2.json"), encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
 
@@ -38,7 +39,7 @@ def test_sort_filter():
     assert response.status_code == 200
 
     with open(
-        "test/characters/characters-name=amy&limit=50&offset=0&sort=number_of_lines.json",
+        corpus.golden("characters/characters-name=amy&limit=50&offset=0&sort=number_of_lines.json"),
         encoding="utf-8",
     ) as f:
         assert response.json() == json.load(f)
@@ -51,7 +52,7 @@ def test_sort_filter2():
     assert response.status_code == 200
 
     with open(
-        "test/characters/characters-name=space&limit=250&offset=42&sort=movie.json",
+        corpus.golden("characters/characters-name=space&limit=250&offset=42&sort=movie.json"),
         encoding="utf-8",
     ) as f:
         assert response.json() == json.load(f)
@@ -60,3 +61,29 @@ def test_sort_filter2():
 def test_404():
     response = client.get("/characters/400")
     assert response.status_code == 404
+
+
+def test_character_network():
+    response = client.get("/characters/0/network?depth=2")
+    assert response.status_code == 200
+
+    network = response.json()
+    assert network["characters"][0] == {"character_id": 0, "character": "BIANCA", "distance": 0}
+    top = client.get("/characters/0").json()["top_conversations"]
+    # edges list the smaller id first, so character 0 is always character_1_id
+    direct = {
+        edge["character_2_id"]: edge["number_of_lines_together"]
+        for edge in network["edges"]
+        if edge["character_1_id"] == 0
+    }
+    for partner in top:
+        assert direct[partner["character_id"]] == partner["number_of_lines_together"]
+
+
+def test_get_characters_batch():
+    response = client.get("/characters:batch?ids=7421,999999,0")
+    assert response.status_code == 200
+    body = response.json()
+    assert [c["character_id"] for c in body["results"]] == [7421, 0]
+    assert body["missing"] == [999999]
+    assert body["results"][0] == client.get("/characters/7421").json()
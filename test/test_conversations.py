@@ -1,6 +1,15 @@
 
+import asyncio
+import uuid
+
+import httpx
+import pytest
+import sqlalchemy
 from fastapi.testclient import TestClient
 
+from src import cache, graph, search
+from src import database as db
+from src.api import conversations
 from src.api.server import app
 
 import json
@@ -82,3 +91,218 @@ def test_add_conversation_5():
     }
     response = client.post("/movies/0/conversations/", json=test)
     assert response.status_code == 200
+
+
+#Testing a batch with valid and invalid conversations
+def test_add_conversations_batch():
+    valid = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [
+            {
+                "character_id": 0,
+                "line_text": "test passed for test_add_conversations_batch"
+            }
+        ]
+    }
+    invalid = dict(valid, character_2_id=0)
+    body = "\n".join(json.dumps(test) for test in [valid, invalid, valid])
+    response = client.post("/movies/0/conversations:batch", content=body)
+    assert response.status_code == 200
+
+    results = response.json()["results"]
+    assert [("conversation_id" in result) for result in results] == [True, False, True]
+    assert results[1]["error"] == "Characters cannot be the same"
+
+
+#Testing that a failed transaction reports the conversations committed before it
+def test_add_conversations_batch_partial_failure(monkeypatch):
+    insert = conversations.insert_conversations
+    calls = []
+
+    async def fail_second(conn, movie_id, batch):
+        calls.append(len(batch))
+        if len(calls) == 2:
+            raise RuntimeError("insert failed")
+        return await insert(conn, movie_id, batch)
+
+    monkeypatch.setattr(conversations, "BATCH_SIZE", 1)
+    monkeypatch.setattr(conversations, "insert_conversations", fail_second)
+    valid = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [
+            {
+                "character_id": 0,
+                "line_text": "test passed for test_add_conversations_batch_partial_failure"
+            }
+        ]
+    }
+    invalid = dict(valid, character_2_id=0)
+    body = "\n".join(json.dumps(test) for test in [valid, invalid, valid, valid])
+    response = client.post("/movies/0/conversations:batch", content=body)
+    assert response.status_code == 500
+
+    detail = response.json()["detail"]
+    assert (detail["created"], detail["failed"]) == (1, 1)
+    assert [result["index"] for result in detail["results"]] == [0, 1]
+    committed = detail["results"][0]["conversation_id"]
+    assert client.get(f"/conversations/{committed}").status_code == 200
+    # the last conversation was never read
+    assert calls == [1, 1]
+
+
+def test_list_conversations():
+    response = client.get("/conversations/?ids=1,999999,0")
+    assert response.status_code == 200
+    body = response.json()
+    assert [c["conv_id"] for c in body["results"]] == [1, 0]
+    assert body["missing"] == [999999]
+    assert body["results"][0] == client.get("/conversations/1").json()
+
+    response = client.get("/movies/0/conversations")
+    assert response.status_code == 200
+    ids = [c["conv_id"] for c in response.json()]
+    assert ids == sorted(ids) and 0 in ids
+
+
+#Testing concurrent posts that commit and roll back on one shared connection
+@pytest.mark.skipif(db.backend != "memory", reason="the memory backend shares one connection")
+def test_concurrent_commits_and_rollbacks():
+    valid = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [
+            {
+                "character_id": 0,
+                "line_text": "test passed for test_concurrent_commits_and_rollbacks"
+            }
+        ]
+    }
+    # in movie 1, so it fails inside the transaction and rolls it back
+    invalid = dict(valid, character_1_id=78, character_2_id=79, lines=[{"character_id": 78, "line_text": "test"}])
+
+    # a copy of the database of its own, since the writes commit
+    uri = f"file:movie_api_{uuid.uuid4().hex}?mode=memory&cache=shared&uri=true"
+    loader = sqlalchemy.create_engine(
+        f"sqlite:///{uri}",
+        poolclass=sqlalchemy.pool.StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+    with db.lazy("memory_loader").connect() as source, loader.connect() as copy:
+        source.connection.driver_connection.backup(copy.connection.driver_connection)
+    engine = db.memory_engine(loader)
+
+    async def post_all():
+        async with httpx.AsyncClient(app=app, base_url="http://test") as http:
+            posts = (http.post("/movies/0/conversations/", json=test) for test in [valid, invalid] * 20)
+            # interleaved transactions can leave the requests waiting forever
+            return await asyncio.wait_for(asyncio.gather(*posts), 30)
+
+    async def saved(ids):
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                sqlalchemy.select(db.conversations.c.conversation_id).where(
+                    db.conversations.c.conversation_id.in_(ids)
+                )
+            )
+            return set(result.scalars())
+
+    served = db.lazy("engine")
+    db.override("engine", engine)
+    try:
+        responses = asyncio.run(post_all())
+        assert [response.status_code for response in responses] == [200, 404] * 20
+        ids = [response.json()["conversation_id"] for response in responses[::2]]
+        assert len(set(ids)) == 20
+        assert asyncio.run(saved(ids)) == set(ids)
+    finally:
+        db.override("engine", served)
+        asyncio.run(engine.dispose())
+        loader.dispose()
+        # the in-process indexes saw the other database's rows
+        search._index = None
+        graph._graph = None
+        cache.responses.clear()
+
+
+#Testing that a character without a statistics row gets one
+@pytest.mark.skipif(db.backend != "memory", reason="deletes rows outside the API")
+def test_add_conversation_creates_stats():
+    async def delete_stats():
+        async with db.engine.begin() as conn:
+            await conn.execute(
+                sqlalchemy.delete(db.character_stats).where(db.character_stats.c.character_id == 0)
+            )
+
+    async def num_lines():
+        async with db.engine.connect() as conn:
+            return (
+                await conn.execute(
+                    sqlalchemy.select(db.character_stats.c.num_lines).where(
+                        db.character_stats.c.character_id == 0
+                    )
+                )
+            ).scalar_one()
+
+    asyncio.run(delete_stats())
+    test = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [
+            {"character_id": 0, "line_text": "test passed for test_add_conversation_creates_stats"},
+            {"character_id": 0, "line_text": "twice"},
+        ]
+    }
+    assert client.post("/movies/0/conversations/", json=test).status_code == 200
+    assert asyncio.run(num_lines()) == 2
+    assert client.post("/movies/0/conversations:batch", content=json.dumps(test)).status_code == 200
+    assert asyncio.run(num_lines()) == 4
+
+
+#Testing that lines a cached batch reported missing are served once added
+@pytest.mark.skipif(db.backend != "memory", reason="expects the ids after the largest one")
+def test_add_conversation_fills_missing_lines():
+    async def last_line_id():
+        async with db.engine.connect() as conn:
+            return (
+                await conn.execute(sqlalchemy.select(sqlalchemy.func.max(db.lines.c.line_id)))
+            ).scalar_one()
+
+    last = asyncio.run(last_line_id())
+    url = f"/lines:batch?ids={last + 1},{last + 2}"
+    assert client.get(url).json()["missing"] == [last + 1, last + 2]
+
+    test = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [
+            {"character_id": 0, "line_text": "test passed for test_add_conversation_fills_missing_lines"},
+            {"character_id": 1, "line_text": "and the reply"},
+        ]
+    }
+    assert client.post("/movies/0/conversations/", json=test).status_code == 200
+    body = client.get(url).json()
+    assert [line["text"] for line in body["results"]] == [line["line_text"] for line in test["lines"]]
+    assert body["missing"] == []
+
+
+#Testing that conversations a cached batch reported missing are served once added
+def test_add_conversation_fills_missing_conversations():
+    test = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [
+            {"character_id": 0, "line_text": "test passed for test_add_conversation_fills_missing_conversations"},
+        ]
+    }
+    first = client.post("/movies/0/conversations/", json=test).json()["conversation_id"]
+    # the ids that follow are free, on either database
+    url = f"/conversations/?ids={first + 1},{first + 2},{first + 3}"
+    assert client.get(url).json()["results"] == []
+
+    body = client.post("/movies/0/conversations:batch", content=json.dumps([test, test])).json()
+    created = [entry["conversation_id"] for entry in body["results"]]
+    assert set(created) <= {first + 1, first + 2, first + 3}
+    body = client.get(url).json()
+    assert sorted(conversation["conv_id"] for conversation in body["results"]) == created
@@ -0,0 +1,102 @@
+import asyncio
+import os
+
+import pytest
+import sqlalchemy
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src import database as db
+from src.api.server import app
+
+client = TestClient(app)
+
+CSV_HEADERS = {
+    "movies.csv": "movie_id,title,year,imdb_rating,imdb_votes,raw_script_url",
+    "characters.csv": "character_id,name,movie_id,gender,age",
+    "conversations.csv": "conversation_id,character1_id,character2_id,movie_id",
+    "lines.csv": "line_id,character_id,movie_id,conversation_id,line_sort,line_text",
+}
+
+
+def write_csvs(directory, names):
+    for name in names:
+        with open(os.path.join(directory, name), "w", encoding="utf8") as f:
+            f.write(CSV_HEADERS[name] + "\n")
+
+
+def test_missing_data_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "data_dir", str(tmp_path / "missing"))
+    with pytest.raises(Exception, match="MOVIE_API_DATA_DIR .* is not a directory"):
+        db.build_memory_loader()
+
+
+def test_missing_csv(monkeypatch, tmp_path):
+    write_csvs(tmp_path, ["movies.csv", "characters.csv", "conversations.csv"])
+    monkeypatch.setattr(db, "data_dir", str(tmp_path))
+    with pytest.raises(Exception, match="lines.csv is missing"):
+        db.build_memory_loader()
+
+
+def test_empty_csvs(monkeypatch, tmp_path):
+    write_csvs(tmp_path, CSV_HEADERS)
+    monkeypatch.setattr(db, "data_dir", str(tmp_path))
+    loader = db.build_memory_loader()
+    try:
+        with loader.connect() as conn:
+            for table in db.metadata_obj.sorted_tables:
+                count = conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(table))
+                assert count.scalar_one() == 0, table.name
+    finally:
+        loader.dispose()
+
+
+def test_pool_options(monkeypatch):
+    monkeypatch.setenv("DB_POOL_MODE", "queue")
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "2.5")
+    options = db.pool_options()
+    assert options["poolclass"] is db.TimedQueuePool
+    assert (options["pool_size"], options["max_overflow"]) == (3, 10)
+    assert (options["pool_timeout"], options["pool_recycle"]) == (2.5, 1800)
+
+
+@pytest.mark.parametrize("name", ["DB_POOL_SIZE", "DB_MAX_OVERFLOW", "DB_POOL_TIMEOUT", "DB_POOL_RECYCLE"])
+def test_malformed_pool_option(monkeypatch, name):
+    monkeypatch.setenv("DB_POOL_MODE", "queue")
+    monkeypatch.setenv(name, "ten")
+    with pytest.raises(Exception, match=f"{name} must be an? (integer|number), not 'ten'"):
+        db.pool_options()
+
+
+def test_malformed_pool_mode(monkeypatch):
+    monkeypatch.setenv("DB_POOL_MODE", "pooled")
+    with pytest.raises(Exception, match="DB_POOL_MODE must be either queue or null"):
+        db.pool_options()
+
+
+def test_debug_pool():
+    response = client.get("/debug/pool")
+    assert response.status_code == 200
+    status = response.json()
+    assert {"mode", "checked_out", "idle", "overflow", "wait_seconds"} <= set(status)
+    assert status["mode"] == ("static" if db.backend == "memory" else db.pool_mode())
+    assert set(status["wait_seconds"]) == {"buckets", "count", "sum"}
+    assert status["wait_seconds"]["buckets"]["+Inf"] == status["wait_seconds"]["count"]
+
+
+def test_debug_pool_queue(monkeypatch):
+    monkeypatch.setenv("DB_POOL_MODE", "queue")
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setattr(db, "backend", "postgres")
+    # the endpoint only reads the pool, so an engine that never connects will do
+    engine = create_async_engine("sqlite+aiosqlite://", **db.pool_options())
+    served = db.lazy("engine")
+    db.override("engine", engine)
+    try:
+        status = client.get("/debug/pool").json()
+    finally:
+        db.override("engine", served)
+        asyncio.run(engine.dispose())
+    assert status["mode"] == "queue"
+    assert (status["size"], status["checked_out"], status["idle"], status["overflow"]) == (3, 0, 0, 0)
@@ -0,0 +1,88 @@
+import asyncio
+import uuid
+
+import pytest
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from src import database as db
+from src.api import export
+from src.api.server import app
+
+import csv
+import io
+import json
+
+client = TestClient(app)
+
+
+def test_export_lines():
+    response = client.get("/export/lines?movie_id=0")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) > 0
+    assert all(line["movie_id"] == 0 for line in lines)
+    assert [line["line_id"] for line in lines] == sorted(line["line_id"] for line in lines)
+
+
+def test_export_characters_csv():
+    response = client.get("/export/characters?movie_id=0&format=csv")
+    assert response.status_code == 200
+
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert {row["character_id"] for row in rows} >= {"0", "1"}
+    assert all(row["movie_id"] == "0" for row in rows)
+
+
+def test_export_empty_csv():
+    response = client.get("/export/conversations?movie_id=888888&format=csv")
+    assert response.status_code == 200
+    assert response.text.strip() == "conversation_id,character1_id,character2_id,movie_id"
+
+
+def test_export_across_batches(monkeypatch):
+    expected = client.get("/export/lines?movie_id=0").text.splitlines()
+
+    monkeypatch.setattr(export, "BATCH_SIZE", 7)
+    lines = client.get("/export/lines?movie_id=0").text.splitlines()
+    assert lines == expected
+
+    rows = list(csv.reader(io.StringIO(client.get("/export/lines?movie_id=0&format=csv").text)))
+    assert rows[0] == ["line_id", "character_id", "movie_id", "conversation_id", "line_sort", "line_text"]
+    assert [row[0] for row in rows[1:]] == [str(json.loads(line)["line_id"]) for line in expected]
+
+
+@pytest.mark.skipif(db.backend != "memory", reason="the memory backend serializes its connections")
+def test_export_releases_connection_between_batches():
+    # a copy of the database of its own, so requests take the engine lock
+    uri = f"file:movie_api_{uuid.uuid4().hex}?mode=memory&cache=shared&uri=true"
+    loader = sqlalchemy.create_engine(
+        f"sqlite:///{uri}",
+        poolclass=sqlalchemy.pool.StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+    with db.lazy("memory_loader").connect() as source, loader.connect() as copy:
+        source.connection.driver_connection.backup(copy.connection.driver_connection)
+    engine = db.memory_engine(loader)
+
+    async def read_while_exporting():
+        body = export.export_lines(None, export.export_format.ndjson).body_iterator
+        # the client hasn't read past the first batch yet; a task of its own,
+        # like a request, so it doesn't share the lock with the query below
+        await asyncio.create_task(body.__anext__())
+        async with engine.connect() as conn:
+            query = conn.execute(sqlalchemy.select(db.characters).where(db.characters.c.character_id == 7421))
+            result = await asyncio.wait_for(query, 5)
+        await body.aclose()
+        return result.one()
+
+    served = db.lazy("engine")
+    db.override("engine", engine)
+    try:
+        assert asyncio.run(read_while_exporting()).character_id == 7421
+    finally:
+        db.override("engine", served)
+        asyncio.run(engine.dispose())
+        loader.dispose()
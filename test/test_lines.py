@@ -1,7 +1,12 @@
 from fastapi.testclient import TestClient
+import pytest
 
+from src import database as db
+from src import search
 from src.api.server import app
+from test import corpus
 
+import asyncio
 import json
 
 client = TestClient(app)
@@ -11,16 +16,22 @@ def test_get_line():
     response = client.get("/lines/66")
     assert response.status_code == 200
 
-    with open("test/lines/66.json", encoding="utf-8") as f:
+    with open(corpus.golden("lines/66.json"), encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
 
 
+@pytest.mark.live
 def test_404():
     response = client.get("/lines/400")
     assert response.status_code == 404
 
 
+def test_404_past_last_line():
+    response = client.get("/lines/99999999")
+    assert response.status_code == 404
+
+
 def test_sort_filter():
     response = client.get(
         "/lines/?text=Why&movie_title=10&limit=50&offset=0&sort=character"
@@ -28,7 +39,7 @@ def test_sort_filter():
     assert response.status_code == 200
 
     with open(
-        "test/lines/filter.json",
+        corpus.golden("lines/filter.json"),
         encoding="utf-8",
     ) as f:
         assert response.json() == json.load(f)
@@ -37,5 +48,92 @@ def test_get_conversation():
     response = client.get("/conversations/0")
     assert response.status_code == 200
 
-    with open("test/lines/0.json", encoding="utf-8") as f:
+    with open(corpus.golden("lines/0.json"), encoding="utf-8") as f:
         assert response.json() == json.load(f)
+
+
+@pytest.mark.live
+def test_relevance_sort():
+    response = client.get("/lines/?text=dakota&limit=50&offset=0&sort=relevance")
+    assert response.status_code == 200
+
+    lines = response.json()
+    assert 66 in [line["line_id"] for line in lines]
+    assert all("dakota" in line["text"].lower() for line in lines)
+
+
+def test_relevance_ranking():
+    index = search.InvertedIndex()
+    index.add(0, 1, "money money money and a lot more words after the money")
+    index.add(1, 1, "money")
+    index.add(2, 2, "no match here")
+    index.add(3, 2, "Money!")
+    index.add(4, 3, "the money talks")
+
+    # shorter lines rank higher, ties go to the lower id
+    assert [line_id for _, line_id in index.search("money")] == [1, 3, 4, 0]
+    assert index.search("money")[0][0] == index.search("money")[1][0]
+    # every word has to match
+    assert [line_id for _, line_id in index.search("money talks")] == [4]
+    assert [line_id for _, line_id in index.search("money", {2, 3})] == [3, 4]
+    assert index.search("nothing") == []
+
+
+@pytest.mark.skipif(db.backend != "memory", reason="ranks with the in-process index")
+def test_relevance_sort_in_process():
+    def search_lines(text):
+        response = client.get(f"/lines/?text={text}&limit=250&sort=relevance")
+        assert response.status_code == 200
+        return response.json()
+
+    lines = search_lines("money")
+    assert lines
+    assert all("money" in search.tokenize(line["text"]) for line in lines)
+    # the same order the index ranks them in
+    index = asyncio.run(search.get_index())
+    assert [line["line_id"] for line in lines] == [
+        line_id for _, line_id in index.search("money")[:250]
+    ]
+
+    # lines of a posted conversation are searchable right away
+    assert search_lines("zyzzyva") == []
+    test = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [{"character_id": 0, "line_text": "a zyzzyva"}],
+    }
+    assert client.post("/movies/0/conversations/", json=test).status_code == 200
+    assert [line["text"] for line in search_lines("zyzzyva")] == ["a zyzzyva"]
+
+
+def test_relevance_sort_requires_text():
+    response = client.get("/lines/?sort=relevance")
+    assert response.status_code == 400
+
+
+def test_server_timing():
+    response = client.get("/lines/?limit=5")
+    assert response.status_code == 200
+    assert 'desc="1 statements, 5 rows"' in response.headers["Server-Timing"]
+
+    routes = client.get("/debug/queries").json()
+    assert routes["GET /lines/"]["statements"]["p50"] == 1
+
+
+def test_metrics():
+    client.get("/lines/?limit=5")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'http_request_duration_seconds_count{route="GET /lines/",status="200"}' in response.text
+    assert "http_requests_in_flight 1" in response.text
+    assert "db_pool_checked_out" in response.text
+
+
+def test_get_lines_batch():
+    response = client.get("/lines:batch?ids=49,999999999,1")
+    assert response.status_code == 200
+    body = response.json()
+    assert [line["line_id"] for line in body["results"]] == [49, 1]
+    assert body["missing"] == [999999999]
+    assert client.get("/lines:batch?ids=1,x").status_code == 400
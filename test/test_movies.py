@@ -1,6 +1,13 @@
+import asyncio
+
 from fastapi.testclient import TestClient
+import pytest
+import sqlalchemy
 
 from src.api.server import app
+from src import cache
+from src import database as db
+from test import corpus
 
 import json
 
@@ -11,7 +18,7 @@ def test_get_movie():
     response = client.get("/movies/44")
     assert response.status_code == 200
 
-    with open("test/movies/44.json", encoding="utf-8") as f:
+    with open(corpus.golden("movies/44.json"), encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
 
@@ -28,7 +35,7 @@ def test_get_movie2():
     response = client.get("/movies/436")
     assert response.status_code == 200
 
-    with open("test/movies/436.json", encoding="utf-8") as f:
+    with open(corpus.golden("movies/436.json"), encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
 
@@ -58,3 +65,122 @@ def test_sort_filter2():
 def test_404():
     response = client.get("/movies/1")
     assert response.status_code == 404
+
+
+def count_statements(path):
+    "returns the number of SQL statements issued while serving path"
+    statements = []
+    cache.responses.clear()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(db.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(path)
+    finally:
+        sqlalchemy.event.remove(db.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200
+    return len(statements)
+
+
+def test_get_movie_statement_count():
+    # movie 602 has 2 characters, movie 289 has 44
+    assert count_statements("/movies/602") == count_statements("/movies/289") == 1
+
+
+def test_cursor_pagination():
+    first = client.get("/movies/?limit=50&offset=0&sort=rating")
+    assert first.status_code == 200
+
+    response = client.get(
+        "/movies/?limit=50&sort=rating&cursor=" + first.headers["X-Next-Cursor"]
+    )
+    assert response.status_code == 200
+    assert response.json() == client.get("/movies/?limit=50&offset=50&sort=rating").json()
+
+
+def test_invalid_cursor():
+    response = client.get("/movies/?cursor=garbage")
+    assert response.status_code == 400
+
+
+def test_cache_invalidated_by_new_conversation():
+    def bianca_lines():
+        response = client.get("/movies/0")
+        assert response.status_code == 200
+        return [c for c in response.json()["top_characters"] if c["character_id"] == 0][0]["num_lines"]
+
+    before = bianca_lines()
+    hits = cache.responses.stats()["routes"]["get_movie"]["hits"]
+    assert bianca_lines() == before
+    assert cache.responses.stats()["routes"]["get_movie"]["hits"] == hits + 1
+
+    test = {
+        "character_1_id": 0,
+        "character_2_id": 1,
+        "lines": [{"character_id": 0, "line_text": "test cache invalidation"}],
+    }
+    assert client.post("/movies/0/conversations/", json=test).status_code == 200
+    assert bianca_lines() == before + 1
+
+
+def test_not_modified():
+    response = client.get("/movies/44")
+    assert response.status_code == 200
+    assert "s-maxage" in response.headers["Cache-Control"]
+
+    etag = response.headers["ETag"]
+    assert client.get("/movies/44", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(
+        "/movies/44", headers={"If-Modified-Since": response.headers["Last-Modified"]}
+    ).status_code == 304
+    assert client.get("/movies/44", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+    # the ETag is the body's, whichever instance built it
+    assert etag == cache.etag(response.content)
+    assert client.get("/movies/0").headers["ETag"] != etag
+    # and a 304 is only for a response that exists
+    assert client.get("/movies/999999", headers={"If-None-Match": etag}).status_code == 404
+
+
+@pytest.mark.skipif(db.backend != "memory", reason="writes outside the API")
+def test_not_modified_after_outside_write():
+    etag = client.get("/movies/0").headers["ETag"]
+
+    # written by another instance, so this one's cache expires rather than being invalidated
+    async def rename():
+        async with db.engine.begin() as conn:
+            await conn.execute(
+                sqlalchemy.update(db.movies).where(db.movies.c.movie_id == 0).values(title="renamed")
+            )
+
+    asyncio.run(rename())
+    assert client.get("/movies/0", headers={"If-None-Match": etag}).status_code == 304
+    cache.responses.clear()
+    response = client.get("/movies/0", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["title"] == "renamed"
+
+
+def test_movie_stats():
+    response = client.get("/movies/0/stats")
+    assert response.status_code == 200
+
+    movie = response.json()
+    assert movie["num_lines"] == sum(c["num_lines"] for c in movie["lines_per_character"])
+    assert movie["num_lines"] == sum(g["num_lines"] for g in movie["lines_by_gender"])
+    assert movie["num_conversations"] == sum(movie["conversation_lengths"].values())
+
+    all_movies = client.get("/stats/movies").json()
+    del movie["lines_per_character"]
+    assert movie in all_movies
+
+
+def test_get_movies_batch():
+    response = client.get("/movies:batch?ids=44,999999,0")
+    assert response.status_code == 200
+    body = response.json()
+    assert [movie["movie_id"] for movie in body["results"]] == [44, 0]
+    assert body["missing"] == [999999]
+    assert body["results"][1] == client.get("/movies/0").json()
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import re
+
+import pytest
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from src import cache
+from src import database as db
+from src.api.server import app
+
+client = TestClient(app)
+
+# Runs the statements behind the hot routes through SQLite's EXPLAIN QUERY
+# PLAN on the seeded local database, and fails when one reads a whole large
+# table: a plain SCAN of it, or a walk over one of its indexes that then sorts
+# everything it read. Small tables with a row per movie may be scanned.
+#
+# With MOVIE_API_TEST_DATABASE=live the same statements go through Postgres'
+# EXPLAIN with sequential scans priced out, so a Seq Scan left in a plan
+# means no index of the migrations can serve it.
+
+LARGE_TABLES = {"lines", "conversations", "characters", "character_stats"}
+
+HOT_ROUTES = [
+    "/movies/44",
+    "/movies:batch?ids=44,0",
+    "/movies/",
+    "/movies/?name=the",
+    "/movies/0/conversations",
+    "/movies/0/stats",
+    "/characters/7421",
+    "/characters:batch?ids=7421,0",
+    "/characters/",
+    "/characters/?sort=number_of_lines",
+    "/characters/?sort=movie",
+    "/lines/0",
+    "/lines:batch?ids=0,1",
+    "/lines/",
+    "/lines/?sort=character",
+    "/conversations/1",
+    "/conversations/?ids=1,2",
+]
+
+SCAN = re.compile(r"^SCAN (\w+)")
+
+
+def full_scans(plan):
+    "returns the large tables a query plan reads in full"
+    details = [row[-1] for row in plan]
+    sorts_everything = "USE TEMP B-TREE FOR ORDER BY" in details
+    scans = set()
+    for detail in details:
+        match = SCAN.match(detail)
+        if match is None or match.group(1) not in LARGE_TABLES:
+            continue
+        if " USING " not in detail or sorts_everything:
+            scans.add(match.group(1))
+    return scans
+
+
+def statements_of(url):
+    "returns the statements and parameters a request runs"
+    cache.responses.clear()
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(db.engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        assert client.get(url).status_code == 200
+    finally:
+        sqlalchemy.event.remove(db.engine.sync_engine, "before_cursor_execute", capture)
+    return statements
+
+
+async def explain(statements):
+    async with db.engine.connect() as conn:
+        return [
+            (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, tuple(parameters))).fetchall()
+            for statement, parameters in statements
+        ]
+
+
+def seq_scans(node):
+    "returns the large tables a Postgres plan node and its children scan sequentially"
+    scans = set()
+    if node["Node Type"] == "Seq Scan" and node["Relation Name"] in LARGE_TABLES:
+        scans.add(node["Relation Name"])
+    for child in node.get("Plans", ()):
+        scans |= seq_scans(child)
+    return scans
+
+
+async def explain_postgres(statements):
+    async with db.engine.connect() as conn:
+        await conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plans = [
+            (await conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, tuple(parameters))).scalar()
+            for statement, parameters in statements
+        ]
+        await conn.rollback()
+    return plans
+
+
+@pytest.mark.skipif(db.backend != "memory", reason="checks plans on the local SQLite database")
+@pytest.mark.parametrize("url", HOT_ROUTES)
+def test_no_full_scans(url):
+    statements = statements_of(url)
+    assert statements
+    for (statement, _), plan in zip(statements, asyncio.run(explain(statements))):
+        assert not full_scans(plan), f"{statement}\n{[row[-1] for row in plan]}"
+
+
+@pytest.mark.live
+@pytest.mark.skipif(db.backend != "postgres", reason="checks plans on Postgres")
+@pytest.mark.parametrize("url", HOT_ROUTES)
+def test_no_seq_scans_on_postgres(url):
+    statements = statements_of(url)
+    assert statements
+    for (statement, _), plan in zip(statements, asyncio.run(explain_postgres(statements))):
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        assert not seq_scans(plan[0]["Plan"]), f"{statement}\n{json.dumps(plan, indent=1)}"